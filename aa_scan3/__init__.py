@@ -0,0 +1,20 @@
+# Software Name : aa-scan3
+# SPDX-FileCopyrightText: Copyright (c) 2020 Orange
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# This software is distributed under the GPLv2;
+# see the COPYING file for more details.
+#
+# Author: Yann E. MORIN <yann.morin@orange.com> et al.
+
+"""
+Generate AppArmor profiles by scanning executables, e.g.:
+
+    import aa_scan3
+    with aa_scan3.AAscanner('/path/to/root', '/path/to/staging') as scanner:
+        for path in ['/usr/bin/foo', '/usr/bin/bar']:
+            text = scanner.render(scanner.scan(path))
+"""
+
+from aa_scan3.scanner import AAscanner, scan  # noqa: F401
+from aa_scan3.utils import AAprofile, AAScanError  # noqa: F401
@@ -0,0 +1,136 @@
+# Software Name : aa-scan3
+# SPDX-FileCopyrightText: Copyright (c) 2020 Orange
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# This software is distributed under the GPLv2;
+# see the COPYING file for more details.
+#
+# Author: Yann E. MORIN <yann.morin@orange.com> et al.
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+
+class AAcache:
+    """Persistent cache of the results of scanning files
+
+    Each result is stored in its own file in the cache directory, and is
+    only valid as long as the scanned file has the same size and mtime,
+    or the same size and content when hashing is enabled. Entries are
+    written to a temporary file that is then renamed, so that concurrent
+    runs sharing the same cache directory never see partial entries.
+
+    When no cache directory is set, the cache is disabled and results are
+    always computed.
+    """
+    VERSION = 1
+
+    def __init__(self, cache_dir=None, use_hash=False, max_size=None):
+        self.dir = cache_dir
+        self.use_hash = use_hash
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Results are got from the scan threads, and the qrc prefetch threads
+        self.lock = threading.Lock()
+
+    def get(self, namespace, path, compute, *extra):
+        """Get the cached result of scanning a file
+        :param namespace: the kind of result, e.g. 'elf.needed'
+        :param path: the path of the scanned file
+        :param compute: called without argument on a cache miss, must
+                        return a JSON-serialisable value
+        :param extra: anything else the result depends on
+        :return: the result, as returned by compute()
+        """
+        if self.dir is None:
+            return compute()
+        try:
+            stamp = self._stamp(path)
+        except OSError:
+            # Missing files are not cached
+            return compute()
+
+        key = hashlib.sha1(json.dumps([AAcache.VERSION, namespace, path, extra]).encode()).hexdigest()
+        entry = os.path.join(self.dir, key[:2], key)
+        try:
+            with open(entry, 'r') as f:
+                data = json.load(f)
+            if data['stamp'] == stamp:
+                with self.lock:
+                    self.hits += 1
+                # Mark as recently used, for eviction
+                os.utime(entry)
+                return data['value']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        with self.lock:
+            self.misses += 1
+        value = compute()
+        self._store(entry, {'path': path, 'stamp': stamp, 'value': value})
+        return value
+
+    def take_counters(self):
+        """:return: a dict of the number of cache hits and misses since the
+                    last call
+        """
+        with self.lock:
+            counters = {'hits': self.hits, 'misses': self.misses}
+            self.hits = self.misses = 0
+        return counters
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_size"""
+        if self.dir is None or self.max_size is None:
+            return
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.dir):
+            for f in filenames:
+                if f.startswith('.tmp-'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(dirpath, f))
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, os.path.join(dirpath, f)))
+                total += st.st_size
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(entry)
+            except FileNotFoundError:
+                # Evicted by a concurrent run
+                pass
+            total -= size
+
+    def _stamp(self, path):
+        st = os.stat(path)
+        if not self.use_hash:
+            return [st.st_size, st.st_mtime_ns]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return [st.st_size, h.hexdigest()]
+
+    def _store(self, entry, data):
+        import tempfile
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(entry), prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp, entry)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except (OSError, TypeError) as e:
+            # The cache is only an optimisation
+            logging.warning('cannot store cache entry for %s: %s', data['path'], e)
@@ -0,0 +1,136 @@
+# Software Name : aa-scan3
+# SPDX-FileCopyrightText: Copyright (c) 2020 Orange
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# This software is distributed under the GPLv2;
+# see the COPYING file for more details.
+#
+# Author: Yann E. MORIN <yann.morin@orange.com> et al.
+
+import collections
+import logging
+import os
+import re
+
+from aa_scan3.utils import AAprofile
+
+
+class AAcompactor:
+    """Fold the path rules of a profile into glob rules, where the rules
+    already cover the files in a directory, as found in the target root
+    directory:
+
+    * 'dir/**' when they cover all the files below dir, recursively;
+    * 'dir/*' when they cover all the files in dir;
+    * 'dir/*.ext' when they cover all the files in dir with that extension.
+
+    Only rules with the same mode are folded together, and rules with an
+    exec mode are never folded. A glob rule is only used if it allows at
+    most threshold existing files that were not allowed with that mode
+    before; with the default of 0, the profile allows the same existing
+    files as before.
+    """
+    GLOB_CHARS = re.compile(r'[*?\[\]{}@]')
+
+    def __init__(self, tree, threshold=0):
+        """
+        :param tree: the AAtree of the target root directory
+        :param threshold: the number of files a glob rule may newly allow
+        """
+        self.tree = tree
+        self.threshold = threshold
+
+    def compact(self, profile, child=None):
+        """Fold the rules of a profile, and of its children
+        :param profile: the AAprofile
+        :param child: the path of the profile, if it is a child profile
+        :return: a tuple (saved, globs): the number of rules removed, and
+                 of glob rules added
+        """
+        groups = collections.defaultdict(set)
+        for path, bits in profile.paths.items():
+            x, m = AAprofile.mode_strings(bits)
+            if x or not m or path.endswith('/') or AAcompactor.GLOB_CHARS.search(path):
+                continue
+            if self.tree.is_file(path):
+                groups[bits].add(path)
+
+        saved = globs = 0
+        for bits in sorted(groups):
+            if len(groups[bits]) < 2:
+                continue
+            for glob, folded in self._fold(profile, bits, groups[bits]):
+                for path in folded:
+                    del profile.paths[path]
+                profile.add_bits(glob, bits)
+                logging.debug('Folded %s rules into %s %s', len(folded), glob, AAprofile.mode_strings(bits)[1])
+                if profile.trace is not None:
+                    profile.trace.rule('fold', child, path=glob, mode=AAprofile.mode_strings(bits)[1],
+                                       folded=sorted(folded))
+                saved += len(folded) - 1
+                globs += 1
+
+        for c in profile.get_children():
+            c_saved, c_globs = self.compact(c, c.path)
+            saved += c_saved
+            globs += c_globs
+        return saved, globs
+
+    def _fold(self, profile, bits, paths):
+        """Find the glob rules for a set of paths with the same mode
+        :return: an iterator over tuples (glob, folded paths)
+        """
+        def allowed(path):
+            return path in paths or (profile.paths.get(path, 0) & bits) == bits
+
+        # Recursively, from the shallowest directories down
+        below = collections.defaultdict(set)
+        for path in paths:
+            d = os.path.dirname(path)
+            while d != '/':
+                below[d].add(path)
+                d = os.path.dirname(d)
+        remaining = set(paths)
+        for d in sorted(below, key=lambda d: (d.count('/'), d)):
+            folded = below[d] & remaining
+            if len(folded) >= 2 and self._missing(d, allowed, True) <= self.threshold:
+                remaining -= folded
+                yield d + '/**', folded
+
+        # Then in each directory, as a whole or by extension
+        in_dir = collections.defaultdict(set)
+        for path in remaining:
+            in_dir[os.path.dirname(path)].add(path)
+        for d in sorted(in_dir):
+            if len(in_dir[d]) < 2:
+                continue
+            if self._missing(d, allowed, False) <= self.threshold:
+                yield d.rstrip('/') + '/*', in_dir[d]
+                continue
+            by_ext = collections.defaultdict(set)
+            for path in in_dir[d]:
+                name = os.path.basename(path)
+                if '.' in name.lstrip('.'):
+                    by_ext[name.rsplit('.', 1)[1]].add(path)
+            for ext in sorted(by_ext):
+                if len(by_ext[ext]) >= 2 and self._missing(d, allowed, False, '.' + ext) <= self.threshold:
+                    yield '{}/*.{}'.format(d.rstrip('/'), ext), by_ext[ext]
+
+    def _missing(self, path, allowed, recursive, suffix=''):
+        """Count the files in a directory that are not allowed yet, up to
+        one more than the threshold
+        :param path: the directory
+        :param allowed: a function telling whether a file is allowed
+        :param recursive: whether to also count the files in sub-directories
+        :param suffix: only count the files with that suffix
+        :return: the number of files not allowed
+        """
+        missing = 0
+        for d in self.tree.walk(path) if recursive else [path]:
+            # Like walk(), the root of a recursive count is not recorded
+            for name, (_, is_file, _) in self.tree.listdir(d, d != path or not recursive).items():
+                if is_file and name.endswith(suffix) and not allowed(os.path.join(d, name)):
+                    missing += 1
+                    if missing > self.threshold:
+                        return missing
+        return missing
@@ -0,0 +1,175 @@
+# Software Name : aa-scan3
+# SPDX-FileCopyrightText: Copyright (c) 2020 Orange
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# This software is distributed under the GPLv2;
+# see the COPYING file for more details.
+#
+# Author: Yann E. MORIN <yann.morin@orange.com> et al.
+
+import mmap
+import struct
+
+
+class ELFError(Exception):
+    pass
+
+
+class NotELFError(ELFError):
+    pass
+
+
+class UnsupportedELFError(ELFError):
+    """The file is an ELF file, but one ELFReader can't parse; a full
+    ELF parser should be used instead.
+    """
+    pass
+
+
+class ELFReader:
+    """Minimal ELF reader, that memory-maps the file and only reads the
+    few structures it is asked about, without copying them.
+
+    Both ELF32 and ELF64, little- and big-endian, are supported.
+    """
+    PT_LOAD = 1
+    PT_DYNAMIC = 2
+    DT_NULL = 0
+    DT_NEEDED = 1
+    DT_STRTAB = 5
+    PN_XNUM = 0xffff
+
+    def __init__(self, path, data=None):
+        """
+        :param path: the path of the file
+        :param data: the content of the file, if already mapped (e.g. by
+                     an AAprobe), in which case it is not closed
+        """
+        self.path = path
+        self.map = None
+        self.owned = data is None
+        if data is None:
+            with open(path, 'rb') as f:
+                head = f.read(16)
+                self._check(head)
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            head = bytes(data[:16])
+            self._check(head)
+            self.map = data
+        self.is64 = head[4] == 2
+        e = '<' if head[5] == 1 else '>'
+        if self.is64:
+            self._ehdr = struct.Struct(e+'QQ6xHHHHH')
+            self._phdr = struct.Struct(e+'II6Q')
+            self._shdr = struct.Struct(e+'IIQQQQ')
+            self._dyn = struct.Struct(e+'qQ')
+            ehdr_off = 0x20
+        else:
+            self._ehdr = struct.Struct(e+'II6xHHHHH')
+            self._phdr = struct.Struct(e+'8I')
+            self._shdr = struct.Struct(e+'IIIIII')
+            self._dyn = struct.Struct(e+'iI')
+            ehdr_off = 0x1c
+        try:
+            (self.phoff, self.shoff, self.phentsize, self.phnum,
+             self.shentsize, self.shnum, self.shstrndx) = self._ehdr.unpack_from(self.map, ehdr_off)
+        except struct.error:
+            self.close()
+            raise UnsupportedELFError('{}: truncated ELF header'.format(path))
+
+    def _check(self, head):
+        if len(head) < 16 or head[:4] != b'\x7fELF':
+            raise NotELFError('{}: not an ELF file'.format(self.path))
+        if head[4] not in (1, 2) or head[5] not in (1, 2):
+            raise UnsupportedELFError('{}: unknown ELF class or data encoding'.format(self.path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        if self.map is not None and self.owned:
+            self.map.close()
+        self.map = None
+
+    def segments(self):
+        """Iterate over the program headers
+        :return: a list of tuples (p_type, p_offset, p_vaddr, p_filesz)
+        """
+        if self.phnum == 0:
+            return
+        if self.phnum == ELFReader.PN_XNUM or self.phentsize < self._phdr.size:
+            raise UnsupportedELFError('{}: unexpected program headers'.format(self.path))
+        for i in range(self.phnum):
+            try:
+                h = self._phdr.unpack_from(self.map, self.phoff + i * self.phentsize)
+            except struct.error:
+                raise UnsupportedELFError('{}: truncated program headers'.format(self.path))
+            if self.is64:
+                p_type, _, p_offset, p_vaddr, _, p_filesz, _, _ = h
+            else:
+                p_type, p_offset, p_vaddr, _, p_filesz, _, _, _ = h
+            yield p_type, p_offset, p_vaddr, p_filesz
+
+    def vaddr_to_offset(self, vaddr):
+        for p_type, p_offset, p_vaddr, p_filesz in self.segments():
+            if p_type == ELFReader.PT_LOAD and p_vaddr <= vaddr < p_vaddr + p_filesz:
+                return vaddr - p_vaddr + p_offset
+        raise UnsupportedELFError('{}: address {:#x} is not loaded'.format(self.path, vaddr))
+
+    def string(self, offset):
+        end = self.map.find(b'\x00', offset)
+        if offset >= len(self.map) or end < 0:
+            raise UnsupportedELFError('{}: string out of bounds'.format(self.path))
+        try:
+            return self.map[offset:end].decode()
+        except UnicodeDecodeError:
+            raise UnsupportedELFError('{}: invalid string'.format(self.path))
+
+    def needed(self):
+        """Get the DT_NEEDED entries, from the PT_DYNAMIC segment
+        :return: a list of strings, empty if the file is not dynamic
+        """
+        dynamic = [(o, s) for t, o, _, s in self.segments() if t == ELFReader.PT_DYNAMIC]
+        if not dynamic:
+            return []
+        offset, size = dynamic[0]
+        needed = []
+        strtab = None
+        for i in range(size // self._dyn.size):
+            try:
+                tag, val = self._dyn.unpack_from(self.map, offset + i * self._dyn.size)
+            except struct.error:
+                raise UnsupportedELFError('{}: truncated dynamic segment'.format(self.path))
+            if tag == ELFReader.DT_NULL:
+                break
+            elif tag == ELFReader.DT_NEEDED:
+                needed.append(val)
+            elif tag == ELFReader.DT_STRTAB:
+                strtab = val
+        if not needed:
+            return []
+        if strtab is None:
+            raise UnsupportedELFError('{}: no string table'.format(self.path))
+        strtab = self.vaddr_to_offset(strtab)
+        return [self.string(strtab + n) for n in needed]
+
+    def sections(self):
+        """Iterate over the section headers
+        :return: a list of tuples (name, sh_offset, sh_size)
+        """
+        if self.shnum == 0 or self.shstrndx == 0:
+            return
+        if self.shentsize < self._shdr.size or self.shstrndx >= self.shnum:
+            raise UnsupportedELFError('{}: unexpected section headers'.format(self.path))
+        try:
+            headers = [self._shdr.unpack_from(self.map, self.shoff + i * self.shentsize)
+                       for i in range(self.shnum)]
+        except struct.error:
+            raise UnsupportedELFError('{}: truncated section headers'.format(self.path))
+        shstrtab = headers[self.shstrndx][4]
+        for sh_name, _, _, _, sh_offset, sh_size in headers:
+            yield self.string(shstrtab + sh_name), sh_offset, sh_size
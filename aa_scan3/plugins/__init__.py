@@ -8,19 +8,90 @@
 # Author: Yann E. MORIN <yann.morin@orange.com> et al.
 
 import glob
-import os.path
+import importlib
 import importlib.util
+import os.path
+
+
+class PluginInfo:
+    """A plugin, that is only imported when its module is first accessed.
+
+    Enabled plugins are imported to register their options, but disabled
+    ones are not: their docstring, for the help text, is read from their
+    source instead.
+    """
+    def __init__(self, name, path, module_name=None):
+        self.name = name
+        self.path = path
+        self.module_name = module_name
+        self._module = None
+        self._source = None
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    @property
+    def module(self):
+        if self._module is None:
+            if self.module_name is None:
+                spec = importlib.util.spec_from_file_location('aa_scan3.{}'.format(self.name), self.path)
+                self._module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(self._module)
+            else:
+                self._module = importlib.import_module(self.module_name)
+        return self._module
+
+    @property
+    def doc(self):
+        if self.loaded:
+            return self.module.__doc__
+        import ast
+        return ast.get_docstring(self.source(), clean=False)
+
+    @property
+    def methods(self):
+        return set(dir(getattr(self.module, 'Scanner', object)))
+
+    def source(self):
+        if self._source is None:
+            import ast
+            with open(self.path, 'rb') as f:
+                self._source = ast.parse(f.read(), self.path)
+        return self._source
+
+
+def discover(errors):
+    """Find the builtin plugins, then the installed ones
+    :param errors: a list to append the exceptions for the installed
+                   plugins that can not be found to; they are not raised,
+                   so that e.g. the help text can still be displayed
+    :return: a dict of plugin names to PluginInfo
+    """
+    found = {}
+    for f in glob.glob(os.path.join(os.path.dirname(__file__), "*.py")):
+        if os.path.isfile(f) and not os.path.basename(f) == "__init__.py":
+            p_name = os.path.basename(f)[:-3]
+            found[p_name] = PluginInfo(p_name, f, None)
 
-files = [f for f in glob.glob(os.path.join(os.path.dirname(__file__), "*.py"))
-         if os.path.isfile(f) and not os.path.basename(f) == "__init__.py"]
+    # Installed plugins are listed explicitly, as finding them from the
+    # packages metadata costs about as much as loading all the plugins.
+    for mod_name in filter(None, os.environ.get('AA_SCAN3_PLUGINS', '').split(',')):
+        p_name = mod_name.split('.')[-1]
+        if p_name in found:
+            errors.append(ValueError('plugin {} ({}) clashes with another plugin'.format(p_name, mod_name)))
+            continue
+        try:
+            spec = importlib.util.find_spec(mod_name)
+        except ImportError:
+            # The parent package is missing
+            spec = None
+        if spec is None or spec.origin is None:
+            errors.append(ImportError('no such plugin module {}'.format(mod_name)))
+            continue
+        found[p_name] = PluginInfo(p_name, spec.origin, mod_name)
+    return found
 
-plugins = {}
-for f in files:
-    p_name = os.path.basename(f)[:-3]
-    name = "aa_scan3.{}".format(p_name)
-    spec = importlib.util.spec_from_file_location(name, f)
-    mod = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(mod)
-    plugins[p_name] = mod
 
-del p_name, name, spec, mod
+errors = []
+plugins = discover(errors)
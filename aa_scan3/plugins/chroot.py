@@ -27,7 +27,7 @@ class Scanner:
     def emit(self, path):
         if path.startswith('/=/'):
             if self.dir is None:
-                self.logger.warning('out-of-chroot path but not in a chroot: {}'.format(path))
+                self.logger.warning('out-of-chroot path but not in a chroot: %s', path)
             return path[2:]
         elif self.dir is not None:
             return '/'.join([self.dir, path])
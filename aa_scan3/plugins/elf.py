@@ -14,11 +14,21 @@ to allow it load the libraries specified in DT_NEEDED flags.
 
 
 import contextlib
-import elftools.elf.elffile as ELF
+import json
+import os
+
+import aa_scan3.elfutils
 
 
 class Scanner:
     def __init__(self, parser):
+        # Lookups are not specific to the file being scanned, so they
+        # are kept across files, when more than one file is scanned.
+        self.needed = dict()
+        self.libdirs = dict()
+        # For each library, the paths it was looked for at
+        self.tried = dict()
+        self.soname_index = None
         parser.add_argument('--lib-dirs', metavar='DIRS',
                             default='/lib,/usr/lib',
                             help='The comma-separated list of directories in which'
@@ -27,43 +37,172 @@ class Scanner:
         parser.add_argument('--self-read', action='store_true',
                             help='Add a rule that allows the executable to read itself.'
                             + ' This is needed when e.g. linking with -zrelro or -znow.')
+        parser.add_argument('--index', metavar='FILE',
+                            help='Load the index of the libraries in the library directories'
+                            + ' from FILE if it is still valid, or save it to FILE otherwise.'
+                            + ' The index is always built when not specified.')
+
+    def prepare(self):
+        # Index the libraries in the library directories once, so that
+        # locating a library is a single lookup, rather than probing all
+        # the library directories in turn.
+        if self.index and os.path.isfile(self.index):
+            self.soname_index = self.load_index(self.index)
+        if self.soname_index is None:
+            self.soname_index = self.build_index()
+            if self.index:
+                self.save_index(self.index)
+
+    def libdir_stamps(self):
+        """Get the mtime of the library directories, which changes when a
+        library is added, removed or renamed in that directory
+        :return: a dict of directory paths to their mtime (or None if missing)
+        """
+        stamps = dict()
+        for d in self.libdir_paths():
+            try:
+                stamps[d] = os.stat(d).st_mtime_ns
+            except OSError:
+                stamps[d] = None
+        return stamps
+
+    def libdir_paths(self):
+        """:return: the list of the paths of the library directories"""
+        return [os.path.join(rootdir, libdir.lstrip('/'))
+                for rootdir in [self.root_dir, self.staging_dir]
+                for libdir in self.lib_dirs.split(',')]
+
+    def build_index(self):
+        """Index the libraries in the library directories
+        :return: a dict of library names (including symlinks) to the list of
+                 (rootdir, libdir) they were found in, by order of precedence
+        """
+        index = dict()
+        for rootdir in [self.root_dir, self.staging_dir]:
+            for libdir in self.lib_dirs.split(','):
+                try:
+                    # Not a context manager, which needs python 3.6; iterating
+                    # over all the entries closes the directory all the same
+                    entries = os.scandir(os.path.join(rootdir, libdir.lstrip('/')))
+                    self.counters['dirs_listed'] += 1
+                    for entry in entries:
+                        # Follows symlinks, so dangling ones are skipped
+                        if entry.is_file():
+                            index.setdefault(entry.name, []).append((rootdir, libdir))
+                except (FileNotFoundError, NotADirectoryError):
+                    pass
+        self.logger('indexed %s libraries', len(index))
+        return index
+
+    def load_index(self, path):
+        self.logger('loading libraries index from %s', path)
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data['stamps'] == self.libdir_stamps():
+                return {lib: [tuple(d) for d in dirs] for lib, dirs in data['sonames'].items()}
+        except (ValueError, KeyError):
+            pass
+        self.logger('-> outdated or invalid index')
+        return None
+
+    def save_index(self, path):
+        self.logger('saving libraries index to %s', path)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'stamps': self.libdir_stamps(), 'sonames': self.soname_index}, f)
+        os.replace(tmp, path)
 
     def once(self, path):
-        if self.self_read and self.ELF_open(self.root_dir, path):
-            with self.ELF_open(self.root_dir, path) as elf:
-                if elf:
-                    self.profile.add_path(path, 'r')
+        if self.self_read and self.get_needed(self.root_dir, path) is not None:
+            self.profile.add_path(path, 'r')
         return []
 
     def scan(self, path):
-        def search_libdir(lib):
-            for rootdir in [self.root_dir, self.staging_dir]:
-                for libdir in self.lib_dirs.split(','):
-                    self.logger('trying to locate {} in {} :: {}'.format(lib, rootdir, libdir))
-                    with self.ELF_open(rootdir, libdir, lib) as elf:
-                        if elf: return libdir  # noqa: E701
+        # Files are looked for in the root directory first, then in staging
+        found = self.probe.locate(path, 'elf')
+        in_root = os.path.join(self.root_dir, path.lstrip('/'))
+        self.deps.add(in_root)
+        self.deps.add(os.path.join(self.staging_dir, path.lstrip('/')))
+        if found is None:
+            self.logger('-> not an ELF or missing')
+            return
+        search_dir = self.root_dir if found == in_root else self.staging_dir
+        needed = self.get_needed(search_dir, path)
+        if needed is None:
+            self.logger('-> not an ELF or missing')
+            return
+        for lib in needed:
+            self.logger('looking for DT_NEEDED %s', lib)
+            libdir = self.search_libdir(lib)
+            self.deps.update(self.tried[lib])
+            if libdir:
+                lib_path = self.profile.joinpath(libdir, lib)
+                self.logger('Adding %s', lib_path)
+                self.profile.add_path(lib_path, 'mr')
+                yield lib_path
+
+    def get_needed(self, search_dir, path):
+        """Get the DT_NEEDED entries of an ELF file
+        :param search_dir: the directory path is relative to
+        :param path: the path of the file
+        :return: a list of DT_NEEDED, or None if path is not an ELF file
+        """
+        key = (search_dir, path)
+        self.deps.add(os.path.join(search_dir, path.lstrip('/')))
+        if key not in self.needed:
+            self.logger('looking for %s in %s', path, search_dir)
+            self.needed[key] = self.cache.get('elf.needed', self.profile.joinpath(search_dir, path),
+                                              lambda: self.read_needed(search_dir, path))
+        return self.needed[key]
+
+    def read_needed(self, *dirs):
+        p = self.profile.joinpath(*dirs)
+        try:
+            with self.probe.open(p) as f:
+                if f.kind != 'elf':
+                    return None
+                with aa_scan3.elfutils.ELFReader(p, f.data) as elf:
+                    self.counters['elf_parses'] += 1
+                    return elf.needed()
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+        except aa_scan3.elfutils.NotELFError:
             return None
+        except aa_scan3.elfutils.UnsupportedELFError as e:
+            self.logger('%s, falling back to a full parse', e)
+            self.counters['full_elf_parses'] += 1
+        with self.ELF_open(*dirs) as elf:
+            return list(self.ELF_get_DT_NEEDED(elf)) if elf else None
 
-        for search_dir in [self.root_dir, self.staging_dir]:
-            self.logger('looking for {} in {}'.format(path, search_dir))
-            with self.ELF_open(search_dir, path) as elf:
-                if not elf:
-                    self.logger('-> not an ELF or missing')
-                    continue
-                for lib in self.ELF_get_DT_NEEDED(elf):
-                    self.logger('looking for DT_NEEDED {}'.format(lib))
-                    libdir = search_libdir(lib)
-                    if libdir:
-                        lib_path = self.profile.joinpath(libdir, lib)
-                        self.logger('Adding {}'.format(lib_path))
-                        self.profile.add_path(lib_path, 'mr')
-                        yield lib_path
-                break
+    def search_libdir(self, lib):
+        """Locate a library
+        :param lib: the name of the library, as listed in DT_NEEDED
+        :return: the directory where the library was found, or None
+        """
+        if lib not in self.libdirs:
+            self.libdirs[lib] = None
+            self.tried[lib] = []
+            if self.soname_index is not None and '/' not in lib:
+                candidates = self.soname_index.get(lib, [])
+            else:
+                candidates = [(rootdir, libdir)
+                              for rootdir in [self.root_dir, self.staging_dir]
+                              for libdir in self.lib_dirs.split(',')]
+            for rootdir, libdir in candidates:
+                self.logger('trying to locate %s in %s :: %s', lib, rootdir, libdir)
+                self.tried[lib].append(self.profile.joinpath(rootdir, libdir, lib))
+                if self.get_needed(rootdir, self.profile.joinpath(libdir, lib)) is not None:
+                    self.libdirs[lib] = libdir
+                    break
+        return self.libdirs[lib]
 
     @contextlib.contextmanager
     def ELF_open(self, *dirs):
+        # pyelftools is slow to import, and seldom needed
+        import elftools.elf.elffile as ELF
         p = self.profile.joinpath(*dirs)
-        self.logger('opening {}'.format(p))
+        self.logger('opening %s', p)
         try:
             with open(p, 'rb') as f:
                 yield ELF.ELFFile(f)
@@ -72,7 +211,7 @@ class Scanner:
         except ELF.ELFError:
             yield
         finally:
-            self.logger('closing {}'.format(p))
+            self.logger('closing %s', p)
 
     def ELF_get_DT_NEEDED(self, elf):
         s = elf.get_section_by_name('.dynamic')
@@ -22,6 +22,9 @@ each such module, generate AppArmor rules for the resources (qml
 or js, but also .so plugins) exported by the module. Finally, for
 each such resource, recurse to identify the modules they import...
 
+The qrc files are parsed natively; rcc is only used, if specified,
+to list the resources of the qrc files that can not be parsed.
+
 The ELF file must have been generated using a modified rcc, that
 stores the path to the qrc, prefixed with a constant pattern,
 in the generated binary (e.g. as a const char*) so that the path
@@ -35,20 +38,103 @@ import os
 import re
 import subprocess
 
+import aa_scan3.elfutils
+
+
+MAJOR_RE = re.compile(r'^([^.]+)\..+')
+
+
+class QmlDir:
+    """The parsed content of a qmldir file, shared by all the imports of
+    the module it describes, whatever their version.
+    """
+    MODULE_RE = re.compile(r'^module\s+(\S+)$')
+    PLUGIN_RE = re.compile(r'^plugin\s(\S+)$')
+    INTERNAL_RE = re.compile(r'^internal\s(\S+)\s(\S+)$')
+    TYPE_RE = re.compile(r'^(?:singleton\s+)?(\S+)\s+(\S+)\s+(\S+)$')
+
+    def __init__(self, lines):
+        self.module = None
+        # The plugins and types of the module, in the order they are
+        # declared, as tuples of (kind, name, version, file), where kind
+        # is 'plugin', 'internal' or 'type'; internal types and plugins
+        # are not versioned, and plugins have no file
+        self.components = []
+        for l in lines:
+            m = QmlDir.MODULE_RE.match(l)
+            if m:
+                self.module = m.group(1)
+                continue
+            m = QmlDir.PLUGIN_RE.match(l)
+            if m:
+                self.components.append(('plugin', m.group(1), None, None))
+                continue
+            m = QmlDir.INTERNAL_RE.match(l)
+            if m:
+                self.components.append(('internal', m.group(1), None, m.group(2)))
+                continue
+            m = QmlDir.TYPE_RE.match(l)
+            if m:
+                self.components.append(('type',) + m.groups())
+        self.versions = dict()
+
+    @staticmethod
+    def read_lines(path):
+        with open(path, 'rb') as f:
+            return [l.decode().strip() for l in f.readlines()]
+
+    def entries(self, ver):
+        """Get the resources and plugins of the module, for a version
+        :param ver: the version of the module
+        :return: a list of tuples of (kind, value), where kind is either
+                 'resource' (and value is the path of the resource,
+                 relative to the module directory), or 'plugin' (and
+                 value is the name of the plugin)
+        """
+        if ver not in self.versions:
+            entries = []
+            for kind, name, version, path in self.components:
+                if kind == 'plugin':
+                    entries.append(('plugin', name))
+                elif kind == 'internal':
+                    entries.append(('resource', path))
+                elif version == ver and not path.startswith('qrc:/'):
+                    # Types built in a qrc file need no rule
+                    entries.append(('resource', path))
+            self.versions[ver] = entries
+        return self.versions[ver]
+
 
 class Scanner:
     def __init__(self, parser):
         self.first = True
         self.known_modules = set()
+        self.scanned_resources = set()
+        self.scanned_private = set()
+        self.modules = dict()
+        self.qmldirs = None
+        self.indexed = False
+        self.qrcs = dict()
+        self.qmldir_models = dict()
+        self.imports = dict()
+        self.prefetched = dict()
+        self.private_dirs = dict()
+        self.executor = None
         parser.add_argument('--rcc', metavar='RCC',
-                            help='The path to the rcc utility to use.'
-                            + ' If not provided, no qrc scan is attempted.')
+                            help='The path to the rcc utility to use to list the'
+                            + ' resources of the qrc files that can not be parsed'
+                            + ' natively. If neither this nor --qrc-pattern is'
+                            + ' provided, no qrc scan is attempted.')
         parser.add_argument('--base-dir', metavar='DIR',
                             help='The path to the directory under which'
                             + ' all qml-related modules are located.')
         parser.add_argument('--pattern', metavar='PATTERN',
                             help='The pattern to filter on to find the'
                             + ' qrc paths.')
+        parser.add_argument('--sections', metavar='SECTIONS',
+                            help='The comma-separated list of ELF sections in'
+                            + ' which to search the qrc paths (e.g. .rodata);'
+                            + ' if not provided, the whole file is searched.')
         parser.add_argument('--files', action='append', metavar='FILE',
                             default=[],
                             help='The path to a qrc file. This option can'
@@ -63,9 +149,25 @@ class Scanner:
         parser.add_argument('--strict', action='store_true',
                             help='Fail on missing resources (qml, js),'
                             + ' rather than ignoring them.')
+        parser.add_argument('--jobs', metavar='N', type=int, default=0,
+                            help='Read the resources to scan in N threads, ahead'
+                            + ' of scanning them; this helps when the resources'
+                            + ' are on high-latency storage, like NFS. 0 means'
+                            + ' to read them when they are scanned.')
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def reset(self):
+        self.first = True
+        self.known_modules = set()
+        self.scanned_resources = set()
+        self.scanned_private = set()
 
     def scan(self, path):
-        if self.rcc is None: return  # noqa: E701
+        if self.rcc is None and self.pattern is None: return  # noqa: E701
         qrc_files = []
         if self.first:
             if self.pattern is None:
@@ -77,47 +179,80 @@ class Scanner:
 
         qrc_files.extend(self.get_qrc_from_file(path))
         for qrc in qrc_files:
-            self.logger('scanning qrc: {}'.format(qrc))
-            for res in self.list_resources(qrc):
-                self.logger('scanning resource: {}'.format(res))
-                yield from self.scan_resource(res)
-                self.logger('done scanning resource: {}'.format(res))
-            self.logger('done scanning qrc: {}\n'.format(qrc))
+            self.logger('scanning qrc: %s', qrc)
+            yield from self.walk(self.list_resources(qrc))
+            self.logger('done scanning qrc: %s\n', qrc)
+        self.logger('%s resources scanned, %s resource rescans and %s private import rescans avoided',
+                    self.counters['resources'], self.counters['resource_rescans'],
+                    self.counters['private_rescans'])
+
+    def walk(self, resources):
+        """Scan resources, and the resources they import, depth-first
+        and iteratively, so that deep imports can not exhaust the stack.
+        Resources are only scanned once per scanned file.
+        :param resources: the resources to scan
+        :return: a list of files to further scan with aa-scan
+        """
+        self.prefetch(resources)
+        todo = list(reversed(resources))
+        while todo:
+            res = todo.pop()
+            if res in self.scanned_resources:
+                self.counters['resource_rescans'] += 1
+                continue
+            self.scanned_resources.add(res)
+            self.counters['resources'] += 1
+            self.logger('scanning resource: %s', res)
+            imported, files = self.scan_resource(res)
+            self.prefetch(imported)
+            todo.extend(reversed(imported))
+            yield from files
 
     def scan_resource(self, path):
         """Scan resources imported by resource in path
         :param path: resource to scan (.qml or .js)
-        :return: a list of files to further scan with aa-scan
+        :return: a tuple of two lists: the imported resources to scan
+                 next, and the files to further scan with aa-scan
         """
+        resources, files = [], []
         if path.endswith('.qml') or path.endswith('.js'):
-            self.logger('looking modules for {}'.format(path))
+            self.logger('looking modules for %s', path)
             for mod, ver in self.get_modules_from_res(path):
-                self.logger('scanning mod={}, ver={}'.format(mod, ver))
+                self.logger('scanning mod=%s, ver=%s', mod, ver)
                 if mod[0] == '"' and mod[-1] == '"':
-                    yield from self.scan_private(path, mod[1:-1])
+                    resources.extend(self.scan_private(path, mod[1:-1]))
                 else:
-                    yield from self.scan_module(mod, ver)
-                self.logger('done scanning mod={}, ver={}'.format(mod, ver))
+                    r, f = self.scan_module(mod, ver)
+                    resources.extend(r)
+                    files.extend(f)
+        return resources, files
 
     def scan_private(self, path, mod):
         """Scan a private module
         :param path: the path to the file the module was imported from
         :param mod: the module name
-        :return: a list of files to further scan with aa-scan
+        :return: a list of resources to scan next
         """
         if not path.startswith(self.profile.joinpath(self.root_dir, self.base_dir)):
-            self.logger('skipping internal, private import {}'.format(path))
-            return
+            self.logger('skipping internal, private import %s', path)
+            return []
 
         mod_path = self.profile.joinpath(os.path.dirname(path), mod)
+        self.deps.add(mod_path)
+        if mod_path in self.scanned_private:
+            self.counters['private_rescans'] += 1
+            return []
+        self.scanned_private.add(mod_path)
         if os.path.isdir(mod_path):
             self.profile.add_path(mod_path[len(self.root_dir):] + '/', 'r')
-            for r in glob.iglob(mod_path + '/*'):
+            if mod_path not in self.private_dirs:
+                self.private_dirs[mod_path] = glob.glob(mod_path + '/*')
+            for r in self.private_dirs[mod_path]:
                 self.profile.add_path(r[len(self.root_dir):], 'r')
-                yield from self.scan_resource(r)
+            return self.private_dirs[mod_path]
         elif os.path.isfile(mod_path):
             self.profile.add_path(mod_path[len(self.root_dir):], 'r')
-            yield from self.scan_resource(mod_path)
+            return [mod_path]
         else:
             raise FileNotFoundError('import of non existent private resource {}'.format(mod))
 
@@ -125,93 +260,252 @@ class Scanner:
         """Scan a module (non private)
         :param mod: the module name
         :param ver: the module version
-        :return: a list of files to further scan with aa-scan
+        :return: a tuple of two lists: the resources to scan next, and
+                 the files to further scan with aa-scan
         """
+        resources, files = [], []
         if len(ver) == 0:
             raise ValueError('module {} without a version'.format(mod))
         if (mod, ver) in self.known_modules:
-            self.logger('skipping already parsed (or being parsed) module {} {}'.format(mod, ver))
-            return
+            self.logger('skipping already parsed (or being parsed) module %s %s', mod, ver)
+            return resources, files
         self.known_modules.add((mod, ver))
 
         for pfx in self.internal:
             if mod.startswith(pfx):
-                self.logger('ignoring module {} {} matching internal prefix {}'.format(mod, ver, pfx))
-                return
+                self.logger('ignoring module %s %s matching internal prefix %s', mod, ver, pfx)
+                return resources, files
 
         mod_dir = self.find_module(mod, ver)
         if mod_dir is None:
             if self.strict:
                 raise FileNotFoundError('missing (internal?) module {} {}'.format(mod, ver))
             else:
-                self.logger.warning('ignoring missing (internal?) module {} {}'.format(mod, ver))
-                return
+                self.logger.warning('ignoring missing (internal?) module %s %s', mod, ver)
+                return resources, files
 
         self.profile.add_path(self.profile.joinpath(mod_dir, 'qmldir'), 'r')
-        with open(self.profile.joinpath(self.root_dir, mod_dir, 'qmldir'), 'rb') as f:
-            for l in [l.decode().strip() for l in f.readlines()]:
-                self.logger('scanning line {}'.format(l))
-                if re.match(r'^.+\s'+ver+'\sqrc:/.+$', l):
-                    self.logger('skipping built-in qrc')
-                elif re.match(r'^(\S.+\s'+ver+'\s.+\S|internal\s\S+\s\S+)$', l):
-                    res = re.sub(r'(\S+\s+)+', '', l)
-                    res_path = self.profile.joinpath(mod_dir, res)
-                    if not os.path.exists(self.profile.joinpath(self.root_dir, res_path)):
-                        if self.strict:
-                            raise FileNotFoundError('missing resource {}'.format(res_path))
-                        else:
-                            self.logger.warning('ignoring missing resource {}'.format(res_path))
-                    self.logger('adding new resource {}'.format(res_path))
-                    self.profile.add_path(res_path, 'r')
-                    yield from self.scan_resource(self.profile.joinpath(self.root_dir, res_path))
-                elif re.match(r'^plugin\s\S+$', l):
-                    plug = re.sub(r'^plugin\s+(\S+)$', r'\1', l)
-                    plug_path = self.profile.joinpath(mod_dir, 'lib'+plug+'.so')
-                    self.logger('adding plugin {}'.format(plug_path))
-                    self.profile.add_path(plug_path, 'mr')
-                    yield plug_path
-                elif len(l):
-                    self.logger('ignoring qmldir rule {}'.format(l))
+        for kind, value in self.get_qmldir(mod_dir).entries(ver):
+            if kind == 'resource':
+                res_path = self.profile.joinpath(mod_dir, value)
+                if not os.path.exists(self.profile.joinpath(self.root_dir, res_path)):
+                    if self.strict:
+                        raise FileNotFoundError('missing resource {}'.format(res_path))
+                    else:
+                        self.logger.warning('ignoring missing resource %s', res_path)
+                self.logger('adding new resource %s', res_path)
+                self.profile.add_path(res_path, 'r')
+                resources.append(self.profile.joinpath(self.root_dir, res_path))
+            else:  # plugin
+                plug_path = self.profile.joinpath(mod_dir, 'lib'+value+'.so')
+                self.logger('adding plugin %s', plug_path)
+                self.profile.add_path(plug_path, 'mr')
+                files.append(plug_path)
+        return resources, files
+
+    def get_qmldir(self, mod_dir):
+        """Get the parsed qmldir of a module, which the profile depends on
+        :param mod_dir: the directory where the module is located
+        :return: a QmlDir object
+        """
+        path = os.path.join(self.root_dir, mod_dir.lstrip('/'), 'qmldir')
+        self.deps.add(path)
+        if mod_dir not in self.qmldir_models:
+            self.logger('parsing %s', path)
+            self.qmldir_models[mod_dir] = QmlDir(self.cache.get('qrc.qmldir', path,
+                                                                lambda: QmlDir.read_lines(path)))
+        return self.qmldir_models[mod_dir]
 
     def list_resources(self, path):
         """List the resources listed in a qrc file
         :param path: path to the qrc file to scan
         :return: a list of strings that are paths to resources
         """
+        self.deps.add(path)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if path not in self.qrcs or self.qrcs[path][0] != mtime:
+            self.qrcs[path] = (mtime, self.cache.get('qrc.resources', path, lambda: self.read_resources(path)))
+        return self.qrcs[path][1]
+
+    def read_resources(self, path):
+        import xml.etree.ElementTree as ET
+        try:
+            return [f for _, f in self.parse_qrc(path)]
+        except OSError as e:
+            # Like rcc, which lists no resources
+            self.logger.warning('cannot read %s: %s, ignoring it', path, e.strerror)
+            return []
+        except ET.ParseError as e:
+            if self.rcc is None:
+                self.logger.warning('cannot parse %s: %s, ignoring it', path, e)
+                return []
+            self.logger('cannot parse %s: %s, falling back to rcc', path, e)
+            return self.rcc_list(path)
+
+    def parse_qrc(self, path):
+        """Parse a qrc file, like rcc would
+        :param path: path to the qrc file
+        :return: a list of tuples of (resource, file), where resource is
+                 the path of the resource in the resource system (i.e.
+                 with the prefix and alias applied, and starting with
+                 ':/'), and file is the absolute path of the file it
+                 is generated from
+        """
+        import xml.etree.ElementTree as ET
+        self.counters['qrc_parses'] += 1
+        qrc_dir = os.path.dirname(os.path.abspath(path))
+        resources = []
+        prefix = '/'
+        for event, elem in ET.iterparse(path, events=('start', 'end')):
+            if elem.tag == 'qresource' and event == 'start':
+                prefix = '/' + (elem.get('prefix') or '').strip('/')
+            elif elem.tag == 'file' and event == 'end':
+                name = (elem.text or '').strip()
+                alias = elem.get('alias') or name
+                file_path = os.path.normpath(os.path.join(qrc_dir, name))
+                if os.path.isdir(file_path):
+                    # Like rcc, add the non-hidden files in the directory, recursively
+                    children = []
+                    for dirpath, dirnames, filenames in os.walk(file_path, followlinks=True):
+                        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+                        children.extend(os.path.join(dirpath, f) for f in filenames if not f.startswith('.'))
+                    for child in sorted(children):
+                        res = os.path.join(alias, os.path.relpath(child, file_path))
+                        resources.append((':' + os.path.normpath(os.path.join(prefix, res)), child))
+                else:
+                    resources.append((':' + os.path.normpath(os.path.join(prefix, alias)), file_path))
+                elem.clear()
+        return resources
+
+    def rcc_list(self, path):
         rcc_cmd = [self.rcc, '--list', path]
+        self.counters['subprocesses'] += 1
         rcc_out = subprocess.Popen(rcc_cmd, stdout=subprocess.PIPE).communicate()[0]
-        yield from (res.decode() for res in rcc_out.splitlines())
+        return [res.decode() for res in rcc_out.splitlines()]
 
     def get_qrc_from_file(self, path):
         """Extract the qrc that are bundled in a file
         :param path: the path to a file from which to extract the list of qrc files
         :return: a list of strings that are paths to qrc files
         """
-        p = '{}:'.format(self.pattern).encode()
         for dir in [self.root_dir, self.staging_dir]:
-            try:
-                with open(self.profile.joinpath(dir, path), 'rb') as f:
-                    for l in (l for l in f.readlines() if l.startswith(p)):
-                        yield l.split(b'\x00')[0].decode()[len(self.pattern)+1:]
-                break
-            except FileNotFoundError:
-                pass
+            self.deps.add(os.path.join(dir, path.lstrip('/')))
+        file_path = self.probe.locate(path)
+        if file_path is None:
+            return []
+        return self.cache.get('qrc.markers', file_path,
+                              lambda: self.read_qrc_markers(file_path),
+                              self.pattern, self.sections)
+
+    def read_qrc_markers(self, path):
+        """Search the qrc markers in an ELF file, at the start of a line
+        :param path: the path to the file
+        :return: a list of strings that are paths to qrc files
+        """
+        with self.probe.open(path) as f:
+            if f.kind != 'elf':
+                return []
+            return self.search_qrc_markers(path, f.data)
+
+    def search_qrc_markers(self, path, data):
+        """:param data: the content of the file, see read_qrc_markers()"""
+        p = '{}:'.format(self.pattern).encode()
+        try:
+            with aa_scan3.elfutils.ELFReader(path, data) as elf:
+                self.counters['elf_parses'] += 1
+                if self.sections:
+                    wanted = self.sections.split(',')
+                    ranges = [(off, off+size) for name, off, size in elf.sections() if name in wanted]
+                else:
+                    ranges = [(0, len(data))]
+        except aa_scan3.elfutils.NotELFError:
+            return []
+        except aa_scan3.elfutils.UnsupportedELFError as e:
+            self.logger('%s, searching the whole file', e)
+            ranges = [(0, len(data))]
+        qrcs = []
+        for start, end in ranges:
+            self.counters['bytes_searched'] += end - start
+            # The file starts with the ELF magic, not a marker
+            pos = data.find(b'\n'+p, start, end)
+            while pos >= 0:
+                qrcs.append(self.read_qrc_marker(data, pos+1+len(p)))
+                pos = data.find(b'\n'+p, pos+1, end)
+        return qrcs
+
+    def read_qrc_marker(self, data, start):
+        # The marker extends to the end of the string or of the line
+        line_end = data.find(b'\n', start)
+        line_end = len(data) if line_end < 0 else line_end+1
+        end = data.find(b'\x00', start, line_end)
+        return data[start:line_end if end < 0 else end].decode()
 
     def get_modules_from_res(self, path):
         """Scan a resource for the modules it needs
         :param path: path to the resource file (a .qml or a .js)
         :return: a list of modules as tuples of (name, version)
         """
+        self.deps.add(path)
+        if path in self.prefetched:
+            self.imports[path] = self.prefetched.pop(path).result()
+        elif path not in self.imports:
+            self.imports[path] = self.load_modules_from_res(path)
+        return self.imports[path]
+
+    def prefetch(self, paths):
+        """Start reading, in the background, the resources that will be
+        scanned next; the resources are still scanned in the same order.
+        :param paths: the paths to the resources
+        """
+        if self.jobs <= 0:
+            return
+        if self.executor is None:
+            # Not in prepare(), as threads do not survive a fork
+            import concurrent.futures
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.jobs)
+        for path in paths:
+            if ((path.endswith('.qml') or path.endswith('.js'))
+                    and path not in self.imports and path not in self.prefetched):
+                self.prefetched[path] = self.executor.submit(self.load_modules_from_res, path)
+
+    def load_modules_from_res(self, path):
+        return [tuple(m) for m in self.cache.get('qrc.imports', path, lambda: self.read_modules_from_res(path))]
+
+    def read_modules_from_res(self, path):
         if path.endswith('.qml'):
             lead = 'import '
             mod_re = re.compile(r'^import\s+(\S+)(\s+(\S+).*)?$')
         else:  # .js
             lead = '.import '
             mod_re = re.compile(r'^\.import\s+(\S+)(\s+(\S+).*)?$')
+        modules = []
         with open(path, 'rb') as f:
             for l in (l.decode().strip() for l in f.readlines() if l.decode().startswith(lead)):
-                self.logger('{}: found module {} version {}'.format(path, mod_re.sub(r'\1', l), mod_re.sub(r'\3', l)))
-                yield (mod_re.sub(r'\1', l), mod_re.sub(r'\3', l))
+                mod, ver = mod_re.sub(r'\1', l), mod_re.sub(r'\3', l)
+                self.logger('%s: found module %s version %s', path, mod, ver)
+                modules.append((mod, ver))
+        return modules
+
+    def index_modules(self):
+        """Index the directories with a qmldir once, so locating a module
+        does not need to probe all its possible locations. Symlinked
+        directories are not followed, so the index is not trusted if there
+        are any.
+        :return: the set of the module directories, or None if not indexed
+        """
+        base_dir = os.path.join(self.root_dir, self.base_dir.lstrip('/'))
+        qmldirs = set()
+        for dirpath, dirnames, filenames in os.walk(base_dir):
+            if any(os.path.islink(os.path.join(dirpath, d)) for d in dirnames):
+                self.logger('symlinked directories in %s, not indexing modules', base_dir)
+                return None
+            if 'qmldir' in filenames:
+                rel_dir = os.path.relpath(dirpath, base_dir)
+                qmldirs.add(os.path.normpath(os.path.join('/', self.base_dir.lstrip('/'), rel_dir)))
+        return qmldirs
 
     def find_module(self, mod, ver):
         """Locate a module
@@ -220,10 +514,28 @@ class Scanner:
         :return: the directory where the module was found
         """
         mod_dir = mod.replace('.', '/')
-        for v in ['.'+ver, re.sub(r'^([^.]+)\..+', r'.\1', ver), '']:
-            d = self.profile.joinpath(self.base_dir, mod_dir+v)
-            self.logger('looking for module {} {} in {}'.format(mod, ver, d))
-            if os.path.isfile(self.profile.joinpath(self.root_dir, d, 'qmldir')):
-                self.logger('--> found')
-                return d
-        return None
+        candidates = [self.profile.joinpath(self.base_dir, mod_dir+v)
+                      for v in ['.'+ver, MAJOR_RE.sub(r'.\1', ver), '']]
+        if (mod, ver) not in self.modules:
+            if not self.indexed:
+                # Not in prepare(), so that runs that scan no QML do not
+                # pay for it
+                self.indexed = True
+                self.qmldirs = self.index_modules()
+            self.modules[(mod, ver)] = None
+            for d in candidates:
+                self.logger('looking for module %s %s in %s', mod, ver, d)
+                if self.qmldirs is not None:
+                    found = d in self.qmldirs
+                else:
+                    found = os.path.isfile(self.profile.joinpath(self.root_dir, d, 'qmldir'))
+                if found:
+                    self.logger('--> found')
+                    self.modules[(mod, ver)] = d
+                    break
+        # The module found depends on the qmldir files looked for
+        for d in candidates:
+            self.deps.add(self.profile.joinpath(self.root_dir, d, 'qmldir'))
+            if d == self.modules[(mod, ver)]:
+                break
+        return self.modules[(mod, ver)]
@@ -11,17 +11,160 @@
 This mangle plugin applies a set of pattern substitutions (aka
 replacements) on the path of pattern rule.
 
+Substitutions can be passed on the command line, or listed in files,
+one per line; empty lines and lines starting with '#' are ignored.
+They are applied in the order they are specified, whether on the command
+line or in files, each to the result of the previous ones.
+
 The @PROG_NAME@ placeholder is automatically replaced with the
 program_invocation_short_name(3) of the scanned executable.
 """
 
 
+import argparse
+import collections
 import re
 
 
+def parse_sed(expr):
+    """Parse a sed(1) substitution
+    :param expr: the substitution, like s/REGEXP/REPLACE/
+    :return: a tuple (REGEXP, REPLACE)
+    """
+    if expr[0] != 's':
+        raise NotImplementedError('Unexpected sed expression {}'.format(expr))
+    esc = '\\\\'
+    sep = expr[1]
+    _r = [re.sub(esc+sep, sep, i) for i in re.split('(?<!'+esc+')'+sep, expr)[1:-1]]
+    return _r[0], _r[1]
+
+
+def literal_prefix(regexp):
+    """Get the literal text any match of a regexp starts with
+    :param regexp: the regexp
+    :return: a tuple (anchored, literal), where anchored is True if the
+             regexp only matches at the start of the string, and literal
+             may be empty if it could not be determined
+    """
+    # Alternatives and inline flags could make any literal optional
+    if '|' in regexp or '(?' in regexp:
+        return False, ''
+    anchored = regexp.startswith('^')
+    i = 1 if anchored else 0
+    literal = []
+    while i < len(regexp):
+        c = regexp[i]
+        step = 1
+        if c == '\\':
+            if i+1 == len(regexp) or regexp[i+1].isalnum():
+                break
+            c = regexp[i+1]
+            step = 2
+        elif c in '.^$*+?{}[]()':
+            break
+        # A quantifier applies to this character, which may then be optional
+        if regexp[i+step:i+step+1] in ('*', '?', '{'):
+            break
+        literal.append(c)
+        i += step
+    return anchored, ''.join(literal)
+
+
+class RuleSet:
+    """Ordered substitutions, compiled so that only the ones that may
+    match a path are tried.
+
+    Substitutions anchored at the start of paths are indexed by their
+    literal prefix in a trie; the other ones by the first three characters
+    of their literal prefix. Only substitutions without a literal prefix
+    are tried on all the paths.
+    """
+    def __init__(self, rules):
+        """
+        :param rules: a list of tuples (REGEXP, REPLACE)
+        """
+        self.rules = [(re.compile(r), repl) for r, repl in rules]
+        self.trie = dict()
+        self.trigrams = collections.defaultdict(list)
+        self.short = []
+        self.always = []
+        for i, (r, _) in enumerate(rules):
+            anchored, literal = literal_prefix(r)
+            if anchored and literal:
+                node = self.trie
+                for c in literal:
+                    node = node.setdefault(c, dict())
+                node.setdefault(None, []).append(i)
+            elif len(literal) >= 3:
+                self.trigrams[literal[:3]].append((i, literal))
+            elif literal:
+                self.short.append((i, literal))
+            else:
+                self.always.append(i)
+
+    def candidates(self, path, start=0):
+        """Get the substitutions that may match a path
+        :param path: the path
+        :param start: only consider the substitutions from this one onward
+        :return: the sorted list of the indexes of the substitutions
+        """
+        found = [i for i in self.always if i >= start]
+        found.extend(i for i, literal in self.short if i >= start and literal in path)
+        node = self.trie
+        for c in path:
+            node = node.get(c)
+            if node is None:
+                break
+            found.extend(i for i in node.get(None, ()) if i >= start)
+        if self.trigrams:
+            seen = set()
+            for j in range(len(path) - 2):
+                for i, literal in self.trigrams.get(path[j:j+3], ()):
+                    if i >= start and i not in seen and path.startswith(literal, j):
+                        seen.add(i)
+                        found.append(i)
+        return sorted(found)
+
+    def apply(self, path):
+        candidates = self.candidates(path)
+        k = 0
+        while k < len(candidates):
+            i = candidates[k]
+            k += 1
+            regexp, repl = self.rules[i]
+            _path = regexp.sub(repl, path)
+            if _path != path:
+                # Later substitutions apply to the new path
+                path = _path
+                candidates = self.candidates(path, i+1)
+                k = 0
+        return path
+
+    def __len__(self):
+        return len(self.rules)
+
+
+class RegexpFileAction(argparse.Action):
+    """Append the substitutions listed in a file to the same list as
+    the ones from the command line, to keep their relative order.
+    """
+    def __call__(self, parser, namespace, values, option_string=None):
+        try:
+            with open(values, 'r') as f:
+                exprs = [l for l in (l.strip() for l in f) if l and not l.startswith('#')]
+        except OSError as e:
+            raise argparse.ArgumentError(self, 'cannot read {}: {}'.format(values, e.strerror))
+        setattr(namespace, self.dest, list(getattr(namespace, self.dest) or []) + exprs)
+        # Not kept in the substitutions, so the files can be listed as dependencies
+        setattr(namespace, self.dest + '_files', list(getattr(namespace, self.dest + '_files', [])) + [values])
+
+
 class Scanner:
     def __init__(self, parser):
         self.first = True
+        self.ruleset = None
+        self.prog_name = None
+        self.regexps_files = []
         parser.add_argument('--regexp', metavar='s/REGEXP/REPLACE/',
                             dest='regexps', action='append', default=[],
                             help='Apply the sed(1) substitution, where any match'
@@ -30,23 +173,31 @@ class Scanner:
                             + ' is not supported). Can be used more than once,'
                             + ' in which case they are applied in the order they'
                             + ' appear on the command line.')
+        parser.add_argument('--regexp-file', metavar='FILE',
+                            dest='regexps', action=RegexpFileAction,
+                            help='Apply the sed(1) substitutions listed in FILE, as'
+                            + ' if each was passed with --replace-regexp. Can be used'
+                            + ' more than once.')
+
+    def prepare(self):
+        self.deps.update(self.regexps_files)
+        self.ruleset = RuleSet([parse_sed(r) for r in self.regexps])
+        self.logger('compiled %s substitutions', len(self.ruleset))
+
+    def reset(self):
+        # @PROG_NAME@ depends on the file being scanned
+        self.first = True
+        self.prog_name = None
 
     def mangle(self, path):
         if self.first:
             self.first = False
-            esc = '\\\\'
-            self._regexps = []
-            for r in self.regexps:
-                if r[0] != 's':
-                    raise NotImplementedError('Unexpected sed expression {}'.format(r))
-                sep = r[1]
-                _r = [re.sub(esc+sep, sep, i) for i in re.split('(?<!'+esc+')'+sep, r)[1:-1]]
-                self._regexps.append((_r[0], _r[1]))
-            prog_name = self.profile.get_path().split('/')[-1]
-            self._regexps.append(('@PROG_NAME@', prog_name))
-
-        for r in self._regexps:
-            self.logger('r={}'.format(r))
-            path = re.sub(r[0], r[1], path)
+            # The profile path is itself mangled, but without @PROG_NAME@
+            self.prog_name = self.profile.get_path().split('/')[-1]
 
-        return path
+        _path = self.ruleset.apply(path)
+        if self.prog_name is not None:
+            _path = re.sub('@PROG_NAME@', self.prog_name, _path)
+        if _path != path:
+            self.logger('%s -> %s', path, _path)
+        return _path
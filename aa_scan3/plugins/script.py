@@ -11,16 +11,20 @@ class Scanner:
                             + ' with -zrelro or -znow.')
 
     def once(self, path):
-        with open(self.profile.joinpath(self.root_dir, path), 'rb') as f:
-            blob = f.read()
-        if blob[:2] != b'#!':
-            return []
-        interpreter = blob.splitlines()[0][2:].decode().lstrip()
+        self.deps.add(self.profile.joinpath(self.root_dir, path))
+        with self.probe.open(self.profile.joinpath(self.root_dir, path)) as f:
+            if f.kind != 'script':
+                return []
+            # Only the first line is read, not the whole file
+            end = f.data.find(b'\n')
+            line = f.data[2:end if end >= 0 else len(f.data)]
+        self.counters['bytes_read'] += len(line)
+        interpreter = line.decode().rstrip('\r').lstrip()
         if interpreter.split()[0] == '/usr/bin/env':
-            self.logger.critical('nested interpreter {!r} not supported'.format(interpreter))
+            self.logger.critical('nested interpreter %r not supported', interpreter)
         self.profile.add_path(path, 'r')
         interpreter = interpreter.split()[0]
-        self.logger('adding interpreter {!r}'.format(interpreter))
+        self.logger('adding interpreter %r', interpreter)
         if self.self_read:
             self.profile.add_path(interpreter, 'r')
         return [interpreter]
@@ -30,6 +30,9 @@ expand-wildcards option), which works as follow:
   - paths are expanded relative to root_dir (as specified with the
     global option --root-dir);
 
+  - the '*', '?', '[...]' and '{a,b}' constructs are expanded as
+    AppArmor does;
+
   - the '**' stem only matches arbitrarily deep directory components,
     but does not match any file; for example '/foo/**.bar' will find
     the directories '/foo/.bar/', '/foo/a.bar/', and '/foo/b/c/d.bar/',
@@ -49,14 +52,18 @@ a consistent indentation in the generated file).
 """
 
 
-import glob
 import os
-import pathlib
 import re
 
 
 class Scanner:
     def __init__(self, parser):
+        # Snippets are not specific to the file being scanned, so they
+        # are only looked for and parsed once, when more than one file
+        # is scanned.
+        self.dirs = dict()
+        self.snippets = dict()
+        self.expanded = dict()
         parser.add_argument('--enable', '--disable', default='--enable',
                             action=parser.ToggleAction(['--enable']),
                             help='Enable or disable snippets.')
@@ -77,34 +84,104 @@ class Scanner:
     def scan(self, path):
         if not self.enable:
             return
-        for snippet in glob.glob(os.path.join(self.staging_dir, path[1:] + '.aa*')):
+        for snippet in self.find_snippets(path):
             yield from self.read_one_snippet(snippet)
 
+    def find_snippets(self, path):
+        """Find the snippets for a file, i.e. the files in the same directory
+        of the staging dir, named after it with any .aa* extension added
+        :param path: the path of the file
+        :return: the list of paths to the snippets
+        """
+        d, name = os.path.split(os.path.join(self.staging_dir, path[1:]))
+        # A snippet may be added to the directory
+        self.deps.add(d)
+        if d not in self.dirs:
+            self.dirs[d] = self.index_dir(d)
+        return self.dirs[d].get(name, [])
+
+    def index_dir(self, d):
+        """Index the snippets in a directory, by the name of the file they
+        apply to; a snippet named 'foo.aa.aa' applies to both 'foo' and
+        'foo.aa'.
+        :param d: the directory
+        :return: a dict of file names to lists of paths to snippets
+        """
+        self.logger('indexing snippets in %r', d)
+        index = dict()
+        try:
+            # Not a context manager, which needs python 3.6
+            entries = os.scandir(d)
+            self.counters['dirs_listed'] += 1
+            for entry in entries:
+                i = entry.name.find('.aa')
+                while i >= 0:
+                    # Like glob, hidden files are not matched by a leading '*'
+                    if i > 0:
+                        index.setdefault(entry.name[:i], []).append(entry.path)
+                    i = entry.name.find('.aa', i+1)
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        return index
+
     def read_one_snippet(self, snippet):
-        self.logger('parsing snippet {!r}'.format(snippet))
+        self.deps.add(snippet)
+        if snippet not in self.snippets:
+            self.snippets[snippet] = self.parse_snippet(snippet)
+        for rule in self.snippets[snippet]:
+            if rule[0] == 'path':
+                _, path, mode = rule
+                self.profile.add_path(path, mode)
+                if 'm' in mode:
+                    if path not in self.expanded:
+                        # The expansion depends on the directories it looked into
+                        with self.tree.recording(set()) as listed:
+                            files = list(self.do_expand_wildcards(path))
+                        self.expanded[path] = (files, [os.path.join(self.root_dir, d.lstrip('/'))
+                                                       for d in sorted(listed)])
+                    files, dirs = self.expanded[path]
+                    self.deps.update(dirs)
+                    yield from files
+            elif rule[0] == 'capability':
+                self.profile.add_capability(rule[1])
+            elif rule[0] == 'network':
+                self.profile.add_network(rule[1], rule[2])
+            elif rule[0] == 'profile':
+                self.profile.start_child_profile(rule[1])
+            elif rule[0] == 'end':
+                self.profile.end_child_profile()
+
+    def parse_snippet(self, snippet):
+        """Parse a snippet
+        :param snippet: the path to the snippet
+        :return: a list of rules, as tuples whose first item is the type
+                 of rule, and the others its parameters
+        """
+        self.logger('parsing snippet %r', snippet)
+        rules = []
+        self.counters['snippets_parsed'] += 1
         with open(snippet, 'r') as f:
             for l in (l.strip().rstrip(',') for l in f):
-                self.logger('  parsing line {!r}'.format(l))
+                self.logger('  parsing line %r', l)
                 if l.startswith('/'):
                     self.logger('    -> is a path')
                     path, mode = re.split(' +', l)
-                    self.profile.add_path(path, mode)
-                    if 'm' in mode:
-                        yield from self.do_expand_wildcards(path)
+                    rules.append(('path', path, mode))
                 elif l.startswith('capability '):
                     self.logger('    -> is a capability')
                     _, cap = re.split(' +', l)
-                    self.profile.add_capability(cap)
+                    rules.append(('capability', cap))
                 elif l.startswith('network '):
                     self.logger('    -> is a network')
                     _, domain, proto = re.split(' +', l)
-                    self.profile.add_network(domain, proto)
+                    rules.append(('network', domain, proto))
                 elif l.startswith('profile '):
                     self.logger('    -> starts a child profile')
-                    self.profile.start_child_profile(re.split(' +', l)[-2])
+                    rules.append(('profile', re.split(' +', l)[-2]))
                 elif l.startswith('}'):
                     self.logger('    -> ends a child profile')
-                    self.profile.end_child_profile()
+                    rules.append(('end',))
+        return rules
 
     def do_expand_wildcards(self, path):
         """Expand wildcards in path, relative to the root_dir, and
@@ -116,14 +193,12 @@ class Scanner:
                 yield path
             return
         if path == '/**':
-            self.logger('not expanding {!r}'.format(path))
+            self.logger('not expanding %r', path)
             return
-        self.logger('will try to expand {!r}'.format(path))
-        # Use path[1:] to get rid of the leading '/' and
-        # get a relative path
-        for f in pathlib.Path(self.root_dir).glob(path[1:]):
-            p = pathlib.Path('/').joinpath(f.relative_to(self.root_dir))
-            self.logger('expanding {!r} -> {!r}'.format(path, str(p)))
-            if not f.is_file():
+        self.logger('will try to expand %r', path)
+        self.counters['globs'] += 1
+        for p in self.tree.glob(path):
+            self.logger('expanding %r -> %r', path, p)
+            if not self.tree.is_file(p):
                 continue
-            yield str(p)
+            yield p
@@ -0,0 +1,145 @@
+# Software Name : aa-scan3
+# SPDX-FileCopyrightText: Copyright (c) 2020 Orange
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# This software is distributed under the GPLv2;
+# see the COPYING file for more details.
+#
+# Author: Yann E. MORIN <yann.morin@orange.com> et al.
+
+import collections
+import mmap
+import os
+import threading
+
+
+class AAfile:
+    """A file opened by an AAprobe, to be used as a context manager
+
+    :ivar path: the path of the file, on the host
+    :ivar kind: 'elf', 'script' (it starts with '#!'), or 'other'
+    :ivar data: the read-only content of the file, memory-mapped so it is
+                not copied; it must not be used outside of the with block
+    """
+    __slots__ = ('path', 'kind', 'data', 'probe', 'users')
+
+    def __init__(self, path, kind, data, probe):
+        self.path = path
+        self.kind = kind
+        self.data = data
+        self.probe = probe
+        self.users = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.probe.release(self)
+
+
+class AAprobe:
+    """Open the files the plugins look at once for all of them
+
+    Files are memory-mapped when a plugin opens them, and the maps of the
+    files most recently used are kept, so the plugins that scan the same
+    file one after the other share them; only a few are kept, as each map
+    holds a file descriptor. The kind of files, and where they are found
+    between the root and staging directories, do not change during a run,
+    so are only looked up once.
+    """
+    MAGIC = [(b'\x7fELF', 'elf'), (b'#!', 'script')]
+    # The number of maps kept open when not in use
+    MAX_IDLE = 8
+
+    def __init__(self, root_dir, staging_dir):
+        self.dirs = [root_dir, staging_dir]
+        self.files = collections.OrderedDict()
+        self.kinds = dict()
+        self.located = dict()
+        self.counters = collections.Counter()
+        # Plugins may scan in threads, see --scan-threads; kind() and
+        # locate() hold it while opening files
+        self.lock = threading.RLock()
+
+    def open(self, path):
+        """Open a file
+        :param path: the path of the file, on the host
+        :return: an AAfile, to be used as a context manager
+        :raise FileNotFoundError: if there is no such file
+        """
+        with self.lock:
+            f = self.files.get(path)
+            if f is not None:
+                self.counters['reuses'] += 1
+                self.files.move_to_end(path)
+                f.users += 1
+                return f
+            with open(path, 'rb') as fd:
+                size = os.fstat(fd.fileno()).st_size
+                # Empty files can not be mapped
+                data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+            self.counters['opens'] += 1
+            kind = 'other'
+            for magic, k in AAprobe.MAGIC:
+                if data[:len(magic)] == magic:
+                    kind = k
+                    break
+            self.kinds[path] = kind
+            f = self.files[path] = AAfile(path, kind, data, self)
+            f.users += 1
+            self._evict()
+            return f
+
+    def release(self, f):
+        """Stop using a file, see AAfile"""
+        with self.lock:
+            f.users -= 1
+            self._evict()
+
+    def _evict(self):
+        idle = [f for f in self.files.values() if not f.users]
+        for f in idle[:len(idle) - AAprobe.MAX_IDLE]:
+            self._close(f)
+
+    def kind(self, path):
+        """:return: the kind of a file (see AAfile), or None if there is
+                    no such file
+        """
+        with self.lock:
+            if path not in self.kinds:
+                try:
+                    # Opening the file classifies it
+                    with self.open(path):
+                        pass
+                except (FileNotFoundError, IsADirectoryError, PermissionError):
+                    self.kinds[path] = None
+            return self.kinds[path]
+
+    def locate(self, path, kind=None):
+        """Find a file in the root directory, or else in the staging directory
+        :param path: the path of the file, relative to those directories
+        :param kind: only find a file of that kind, e.g. 'elf'
+        :return: the path of the file on the host, or None if not found
+        """
+        key = (path, kind)
+        with self.lock:
+            if key not in self.located:
+                self.located[key] = None
+                for d in self.dirs:
+                    p = os.path.join(d, path.lstrip('/'))
+                    k = self.kind(p)
+                    if k is not None and (kind is None or k == kind):
+                        self.located[key] = p
+                        break
+            return self.located[key]
+
+    def reset(self):
+        """Close the files opened during a scan"""
+        with self.lock:
+            for f in list(self.files.values()):
+                self._close(f)
+
+    def _close(self, f):
+        if isinstance(f.data, mmap.mmap):
+            f.data.close()
+        del self.files[f.path]
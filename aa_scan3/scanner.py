@@ -0,0 +1,326 @@
+# Software Name : aa-scan3
+# SPDX-FileCopyrightText: Copyright (c) 2020 Orange
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# This software is distributed under the GPLv2;
+# see the COPYING file for more details.
+#
+# Author: Yann E. MORIN <yann.morin@orange.com> et al.
+
+import collections
+import logging
+import os
+
+import aa_scan3.cache
+import aa_scan3.compact
+import aa_scan3.probe
+import aa_scan3.scheduler
+import aa_scan3.stats
+import aa_scan3.trace
+import aa_scan3.utils
+import aa_scan3.plugins
+
+
+def plugin_types(methods):
+    """:return: the set of types ('scan', 'mangle') of a plugin, from the
+                methods of its Scanner class
+    """
+    types = set()
+    if 'once' in methods or 'scan' in methods:
+        types.add('scan')
+    if 'mangle' in methods or 'emit' in methods:
+        types.add('mangle')
+    return types
+
+
+def load_plugins(parser, disabled=()):
+    """Load the plugins, and register their options
+    :param parser: the AAScanArgParser in which the options of each plugin
+                   are registered, in a group of their own
+    :param disabled: the names of the plugins not to load; only their help
+                     text is registered
+    :return: a dict of plugin names to their Scanner instance
+    """
+    scanners = dict()
+    for plugin in sorted(aa_scan3.plugins.plugins):
+        p = aa_scan3.plugins.plugins[plugin]
+        if plugin in disabled:
+            parser.add_argument_group(title='plugin {} [disabled]'.format(plugin), description=p.doc)
+            continue
+        types = plugin_types(p.methods)
+        if len(types) == 0:
+            raise NotImplementedError('Plugin {} is neither scan nor mangle'.format(plugin))
+        group = parser.add_argument_group(title='plugin {} [{}]'.format(plugin, ', '.join(types)),
+                                          description=p.doc)
+        scanners[plugin] = p.module.Scanner(aa_scan3.utils.AAScanArgParser._ArgGroupPlugin(plugin, group))
+    return scanners
+
+
+class AAscanner:
+    """Generate the AppArmor profiles of files, with the plugins
+
+    The plugins are set up (see prepare()) once, when the scanner is
+    created, and are then reused for each scanned file, so what they
+    learnt about the target (e.g. where libraries are located) is shared
+    by all the scans, as are the cache and the index of the root directory.
+    Errors are raised as exceptions, e.g. an AAScanError when a plugin
+    reports a critical error.
+    """
+    PHASES = ['prepare', 'reset', 'once', 'scan', 'mangle', 'emit']
+
+    def __init__(self, root_dir, staging_dir, plugins=None, plugin_options=None,
+                 cache_dir=None, cache_hash=False, cache_max_size=256, scan_threads=1,
+                 compact=False, compact_threshold=0, enforce=True, stats=False, trace=False):
+        """
+        :param root_dir: the target root directory
+        :param staging_dir: the staging (aka sysroot) directory
+        :param plugins: a dict of plugin names to their Scanner instance, as
+                        returned by load_plugins(); all the plugins are
+                        loaded when not specified
+        :param plugin_options: a dict of plugin names to dicts of their options,
+                               as the attributes the plugin expects them in,
+                               e.g. {'elf': {'lib_dirs': '/lib,/usr/lib'}};
+                               options that are not specified keep their
+                               default value when the plugins are loaded here
+        :param cache_dir: the directory to cache the results of scans in, or
+                          None to not cache them
+        :param cache_hash: whether cached results are checked against the
+                           content of the scanned files, rather than their mtime
+        :param cache_max_size: the size, in megabytes, over which the least
+                               recently used cached results are evicted
+        :param scan_threads: the number of threads to scan the files of a
+                             profile in
+        :param compact: whether to fold rules into glob rules
+        :param compact_threshold: the number of files a glob rule may newly allow
+        :param enforce: whether profiles are rendered in enforced mode, rather
+                        than complain mode
+        :param stats: whether to gather statistics, see take_stats()
+        :param trace: whether to trace the provenance of rules, see trace
+        """
+        for d in [root_dir, staging_dir]:
+            if not os.path.isdir(d):
+                raise NotADirectoryError('no such directory: {!r}'.format(d))
+        if scan_threads < 1:
+            raise ValueError('invalid number of scan threads: {}'.format(scan_threads))
+        if compact_threshold < 0:
+            raise ValueError('invalid compaction threshold: {}'.format(compact_threshold))
+        self.root_dir = os.path.abspath(root_dir)
+        self.staging_dir = os.path.abspath(staging_dir)
+        self.enforce = enforce
+
+        options = collections.defaultdict(dict)
+        defaults = plugins is None
+        if defaults:
+            if aa_scan3.plugins.errors:
+                raise aa_scan3.plugins.errors[0]
+            parser = aa_scan3.utils.AAScanArgParser()
+            plugins = load_plugins(parser)
+            args = vars(parser.parse_args([]))
+            for plugin in plugins:
+                options[plugin] = {a[len(plugin)+1:]: v for a, v in args.items() if a.startswith(plugin+'_')}
+        for plugin, values in (plugin_options or {}).items():
+            if plugin not in plugins:
+                raise ValueError('no such plugin {}'.format(plugin))
+            for name, value in values.items():
+                if defaults and name not in options[plugin] and not hasattr(plugins[plugin], name):
+                    raise ValueError('plugin {} has no option {}'.format(plugin, name))
+                options[plugin][name] = value
+        self.plugins = plugins
+
+        # The plugins that implement each method
+        self.phases = collections.defaultdict(list)
+        for plugin in sorted(plugins):
+            methods = aa_scan3.plugins.plugins[plugin].methods
+            for phase in AAscanner.PHASES + ['close']:
+                if phase in methods:
+                    self.phases[phase].append(plugin)
+
+        self.cache = aa_scan3.cache.AAcache(cache_dir, cache_hash, cache_max_size << 20)
+        # Shared by all the plugins, so each directory is listed at most once
+        self.tree = aa_scan3.utils.AAtree(self.root_dir)
+        # Shared by all the plugins, so the ones scanning the same file share it
+        self.probe = aa_scan3.probe.AAprobe(self.root_dir, self.staging_dir)
+        self.compactor = aa_scan3.compact.AAcompactor(self.tree, compact_threshold) if compact else None
+
+        # Only wrap the plugins methods when needed, so it costs nothing otherwise
+        self.stats = aa_scan3.stats.AAstats() if stats else None
+        self.trace = aa_scan3.trace.AAtrace() if trace else None
+
+        # The files all the profiles depend on, e.g. read when preparing the plugins
+        self.run_deps = set()
+
+        for plugin, scanner in plugins.items():
+            scanner.logger = aa_scan3.utils.AALogger(plugin)
+            scanner.cache = self.cache
+            scanner.tree = self.tree
+            scanner.probe = self.probe
+            scanner.counters = collections.Counter()
+            scanner.deps = self.run_deps
+            scanner.root_dir = self.root_dir
+            scanner.staging_dir = self.staging_dir
+            for name, value in options[plugin].items():
+                setattr(scanner, name, value)
+            if self.stats:
+                for phase in AAscanner.PHASES:
+                    if plugin in self.phases[phase]:
+                        setattr(scanner, phase, self.stats.wrap(plugin, phase, getattr(scanner, phase)))
+            if self.trace:
+                for phase in ['once', 'scan', 'mangle', 'emit']:
+                    if plugin in self.phases[phase]:
+                        setattr(scanner, phase, self.trace.wrap(plugin, phase, getattr(scanner, phase)))
+
+        # The paths are transformed by the same plugins all along the scan, and
+        # many times over, so the transformations are memoized. Mangling depends
+        # on the profile (e.g. @PROG_NAME@), so is only memoized for a profile.
+        self.mangle_path = aa_scan3.utils.AApathfilter('mangle', [(p, plugins[p].mangle)
+                                                                  for p in self.phases['mangle']])
+        self.emit_path = aa_scan3.utils.AApathfilter('emit', [(p, plugins[p].emit)
+                                                              for p in self.phases['emit']])
+
+        # Plugins are always run in the same order, so the scans are reproducible
+        self.scheduler = aa_scan3.scheduler.AAscheduler([(p, plugins[p].scan) for p in self.phases['scan']],
+                                                        self.mangle_path, scan_threads, self.trace)
+
+        for p in self.phases['prepare']:
+            logging.debug('Running %s.prepare', p)
+            plugins[p].prepare()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def scan(self, path, deps=None):
+        """Scan a file, and the files it needs
+        :param path: the path of the file, relative to the root directory
+        :param deps: a set to add the paths of the files and directories the
+                     profile depends on to, see dependencies()
+        :return: the AAprofile of the file, with its rules mangled but not
+                 emitted yet, see render()
+        """
+        logging.debug('=== Scanning %s', path)
+        if deps is None:
+            deps = set()
+        if self.trace:
+            self.trace.start(path)
+        profile = aa_scan3.utils.AAprofile(path, self.mangle_path, self.trace)
+        recorder = aa_scan3.scheduler.AArecorder(profile)
+        for scanner in self.plugins.values():
+            scanner.profile = recorder
+            scanner.counters = collections.Counter()
+            scanner.deps = deps
+        deps.add(os.path.join(self.root_dir, path.lstrip('/')))
+        self.mangle_path.clear()
+        self.probe.reset()
+        for p in self.phases['reset']:
+            logging.debug('Running %s.reset for %s', p, path)
+            self.plugins[p].reset()
+
+        scan_files = {path}
+        for p in self.phases['once']:
+            logging.debug('Running %s.once on %s', p, path)
+            _f = self.plugins[p].once(path)
+            _f and logging.debug('Adding files %s', _f)
+            scan_files.update(_f)
+
+        all_files, depth = self.scheduler.run(recorder, sorted(scan_files))
+        if self.stats:
+            self.stats.loop_depth(depth)
+            self.stats.count('run', {'targets': 1, 'files_scanned': len(all_files)})
+
+        if self.compactor:
+            # The folded rules depend on the content of the directories
+            with self.tree.recording(set()) as listed:
+                saved, globs = self.compactor.compact(profile)
+            deps.update(os.path.join(self.root_dir, d.lstrip('/')) for d in listed)
+            logging.debug('Compaction saved %s rules, with %s glob rules', saved, globs)
+            if self.stats:
+                self.stats.count('compact', {'rules_saved': saved, 'globs': globs})
+        return profile
+
+    def render(self, profile):
+        """:return: the text of a profile, with its rules emitted"""
+        logging.debug('---')
+        logging.debug('Emiting profile...')
+        lines = []
+        self._dump_profile(lines, 0, profile)
+        return ''.join(lines)
+
+    def dependencies(self, deps):
+        """:return: the sorted list of the files and directories a profile
+                    depends on, from the ones gathered by scan(), and the
+                    ones all the profiles depend on
+        """
+        # Files that were looked for but not found are not dependencies
+        return sorted(d for d in {os.path.normpath(d) for d in deps | self.run_deps} if os.path.exists(d))
+
+    def take_stats(self):
+        """:return: the AAstats gathered since the last call, or None if
+                    statistics are not gathered
+        """
+        if not self.stats:
+            return None
+        for plugin, scanner in self.plugins.items():
+            self.stats.count(plugin, scanner.counters)
+            scanner.counters = collections.Counter()
+        self.stats.count('cache', self.cache.take_counters())
+        self.stats.count('probe', self.probe.counters)
+        self.probe.counters.clear()
+        return self.stats.take()
+
+    def close(self):
+        """Evict the least recently used cached results, and release the
+        files and threads used by the scans and by the plugins
+        """
+        for p in self.phases['close']:
+            logging.debug('Running %s.close', p)
+            self.plugins[p].close()
+        self.cache.evict()
+        self.probe.reset()
+        if self.scheduler.executor is not None:
+            self.scheduler.executor.shutdown()
+            self.scheduler.executor = None
+
+    def _dump_profile(self, lines, depth, profile):
+        def dump(rule):
+            lines.append('{:{width}}{}\n'.format('', rule, width=4*depth))
+
+        path = profile.get_path()
+        dump('{}{}{} {{'.format('profile ' if depth else '',
+                                self.emit_path(path),
+                                '' if self.enforce else ' flags=(complain)'))
+
+        rules = [(self.emit_path(path), mode) for path, mode in profile.get_paths()]
+        for path, mode in sorted(rules, key=lambda x: x[0]):
+            dump('    {} {},'.format(path, mode))
+
+        for capability in sorted(profile.get_capabilities()):
+            dump('    capability {},'.format(capability))
+
+        for domain, proto in sorted(profile.get_networks()):
+            dump('    network {} {},'.format(domain, proto))
+
+        for child in profile.get_children():
+            dump('    {} Cx,'.format(self.emit_path(child.get_path())))
+            self._dump_profile(lines, depth+1, child)
+
+        dump('}')
+
+
+def scan(path, root_dir, staging_dir, plugin_options=None, render=True, **options):
+    """Generate the AppArmor profile of a file, with a new AAscanner; to
+    scan more than one file, use an AAscanner, so that the plugins are
+    only set up once
+    :param path: the path of the file, relative to the root directory
+    :param root_dir: the target root directory
+    :param staging_dir: the staging (aka sysroot) directory
+    :param plugin_options: the options of the plugins, see AAscanner
+    :param render: whether to return the text of the profile, rather than
+                   the AAprofile
+    :param options: the other options of AAscanner
+    :return: the text of the profile, or its AAprofile
+    """
+    with AAscanner(root_dir, staging_dir, plugin_options=plugin_options, **options) as scanner:
+        profile = scanner.scan(path)
+        return scanner.render(profile) if render else profile
@@ -0,0 +1,190 @@
+# Software Name : aa-scan3
+# SPDX-FileCopyrightText: Copyright (c) 2020 Orange
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# This software is distributed under the GPLv2;
+# see the COPYING file for more details.
+#
+# Author: Yann E. MORIN <yann.morin@orange.com> et al.
+
+import collections
+import logging
+import threading
+
+from aa_scan3.utils import AAprofile
+
+
+class AArecorder:
+    """Stand-in for an AAprofile, given to the plugins as their profile
+
+    In a scan task running in a worker thread, the calls that change the
+    profile are recorded rather than applied, so they can be replayed in
+    a deterministic order, once all the tasks are done. Anywhere else,
+    e.g. in once() or mangle(), they are applied right away.
+    """
+    joinpath = staticmethod(AAprofile.joinpath)
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.local = threading.local()
+
+    def get_path(self):
+        return self.profile.get_path()
+
+    def add_path(self, path, mode):
+        self._call('add_path', path, mode)
+
+    def add_capability(self, capability):
+        self._call('add_capability', capability)
+
+    def add_network(self, domain, protocol):
+        self._call('add_network', domain, protocol)
+
+    def start_child_profile(self, path):
+        self._call('start_child_profile', path)
+
+    def end_child_profile(self):
+        self._call('end_child_profile')
+
+    def record(self, calls):
+        """Record the calls the current thread makes in calls, or stop
+        recording them if calls is None
+        """
+        self.local.calls = calls
+
+    def replay(self, calls):
+        for method, *args in calls:
+            getattr(self.profile, method)(*args)
+
+    def _call(self, method, *args):
+        calls = getattr(self.local, 'calls', None)
+        if calls is None:
+            getattr(self.profile, method)(*args)
+        else:
+            calls.append((method,) + args)
+
+
+class AAscheduler:
+    """Scan the files a profile needs, from a queue of files to scan
+
+    Each file is normalised (i.e. mangled) once, when it is first found,
+    and is then passed to the scan() method of each plugin; the files
+    those yield are queued in turn, until no new file is found.
+
+    With more than one thread, the scans of different plugins run in a
+    pool of threads, while each plugin scans the files one at a time, in
+    the order a single thread would scan them in, so plugins need not be
+    thread-safe, and what they remember from a file to the next is the
+    same. The files a scan yields are queued, and its changes to the
+    profile applied, once all the plugins scanned the files before, in
+    that order too, so the profile does not depend on the order the
+    scans finished in.
+    """
+    def __init__(self, scanners, path_filter, threads=1, trace=None):
+        """
+        :param scanners: a list of tuples (plugin, scan method), in the order
+                         the plugins are run on a file
+        :param path_filter: the AApathfilter that mangles the found files
+        :param threads: the number of threads to scan files in
+        :param trace: the AAtrace, if the scans are traced
+        """
+        self.scanners = scanners
+        self.filter = path_filter
+        self.threads = threads
+        self.trace = trace
+        # Created on first use, as threads do not survive a fork
+        self.executor = None
+        self.locks = [threading.Lock() for _ in scanners]
+        self.depth = dict()
+        self.queue = collections.deque()
+
+    def run(self, recorder, files):
+        """Scan files, and the files their scans yield
+        :param recorder: the AArecorder given to the plugins
+        :param files: the files to scan first
+        :return: a tuple (scanned, depth): the set of scanned files, and the
+                 length of the longest chain of files that were found
+        """
+        self.depth = dict()
+        self.queue = collections.deque()
+        for f in files:
+            self._add(f, 1)
+        if self.threads > 1 and self.queue:
+            self._run_threads(recorder)
+        else:
+            while self.queue:
+                path, depth = self.queue.popleft()
+                for i in range(len(self.scanners)):
+                    for f in self._scan(i, path):
+                        self._add(f, depth + 1)
+        return set(self.depth), max(self.depth.values(), default=0)
+
+    def _add(self, f, depth):
+        path = self.filter.raw(f)
+        if self.trace:
+            self.trace.rename({f: path})
+        if path not in self.depth:
+            self.depth[path] = depth
+            self.queue.append((path, depth))
+
+    def _scan(self, i, path):
+        plugin, scan = self.scanners[i]
+        with self.locks[i]:
+            logging.debug('Running %s.scan on %s', plugin, path)
+            found = list(scan(path) or [])
+        if found:
+            logging.debug('Adding files %s', found)
+        return found
+
+    def _run_threads(self, recorder):
+        import concurrent.futures
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+
+        def task(i, path):
+            calls = []
+            recorder.record(calls)
+            try:
+                return self._scan(i, path), calls
+            finally:
+                recorder.record(None)
+
+        # The files, in the order a single thread would scan them in, and
+        # for each plugin, the index of the next file it scans
+        serial = []
+        next_scan = [0] * len(self.scanners)
+        applied = 0
+        results = dict()
+        pending = dict()
+        try:
+            while True:
+                serial.extend(self.queue)
+                self.queue.clear()
+                for i in range(len(self.scanners)):
+                    n = next_scan[i]
+                    if n < len(serial) and i not in pending.values():
+                        pending[self.executor.submit(task, i, serial[n][0])] = i
+                        next_scan[i] += 1
+                if not pending:
+                    break
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    i = pending.pop(future)
+                    results[(next_scan[i] - 1, i)] = future.result()
+                # Once all the plugins scanned a file, queue the files they
+                # found and apply their changes, as a single thread would
+                while all((applied, i) in results for i in range(len(self.scanners))):
+                    path, depth = serial[applied]
+                    for i in range(len(self.scanners)):
+                        found, calls = results.pop((applied, i))
+                        if self.trace:
+                            self.trace.current = (self.scanners[i][0], 'scan', path)
+                        recorder.replay(calls)
+                        for f in found:
+                            self._add(f, depth + 1)
+                    applied += 1
+        finally:
+            for future in pending:
+                future.cancel()
+            if self.trace:
+                self.trace.current = None
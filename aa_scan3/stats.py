@@ -0,0 +1,119 @@
+# Software Name : aa-scan3
+# SPDX-FileCopyrightText: Copyright (c) 2020 Orange
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# This software is distributed under the GPLv2;
+# see the COPYING file for more details.
+#
+# Author: Yann E. MORIN <yann.morin@orange.com> et al.
+
+import collections
+import csv
+import functools
+import json
+import time
+
+
+class AAstats:
+    """Timings and counters of a run
+
+    Metrics are grouped by scope: 'run' for the run as a whole, 'cache'
+    for the persistent cache, and the name of a plugin for the calls to
+    that plugin and the counters it maintains.
+
+    Statistics are only gathered when enabled, by wrapping the methods of
+    the plugins, so that they cost nothing otherwise.
+    """
+    # Methods that may return generators, which must be consumed to time them
+    GENERATORS = {'once', 'scan'}
+
+    def __init__(self):
+        self.metrics = collections.defaultdict(collections.Counter)
+        self.max_depth = 0
+
+    def wrap(self, plugin, phase, method):
+        """Wrap a plugin method, to time and count its calls
+        :param plugin: the name of the plugin
+        :param phase: the name of the method, e.g. 'scan'
+        :param method: the bound method
+        :return: the wrapped method
+        """
+        calls = '{}.calls'.format(phase)
+        wall = '{}.time'.format(phase)
+        yielded = '{}.yielded'.format(phase)
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                ret = method(*args, **kwargs)
+                if phase in AAstats.GENERATORS and ret is not None:
+                    ret = list(ret)
+                    self.metrics[plugin][yielded] += len(ret)
+                return ret
+            finally:
+                # Looked up now, as take() replaces the metrics
+                self.metrics[plugin][wall] += time.perf_counter() - start
+                self.metrics[plugin][calls] += 1
+        return wrapper
+
+    def count(self, scope, counters):
+        """Add counters to a scope
+        :param scope: the name of the scope, e.g. a plugin name
+        :param counters: a dict of counter names to values
+        """
+        self.metrics[scope].update(counters)
+
+    def loop_depth(self, depth):
+        """Record the length of the longest chain of files the scans found
+        for a profile, e.g. an executable, a library it needs, and so on
+        """
+        self.metrics['run']['scan_loops'] += depth
+        self.max_depth = max(self.max_depth, depth)
+
+    def take(self):
+        """Get the statistics gathered so far, and start afresh
+        :return: an AAstats holding the statistics gathered so far
+        """
+        taken = AAstats()
+        taken.metrics, self.metrics = self.metrics, collections.defaultdict(collections.Counter)
+        taken.max_depth, self.max_depth = self.max_depth, 0
+        return taken
+
+    def merge(self, other):
+        """Add the statistics of another AAstats, e.g. from a worker"""
+        for scope, counters in other.metrics.items():
+            self.metrics[scope].update(counters)
+        self.max_depth = max(self.max_depth, other.max_depth)
+
+    def rows(self):
+        """:return: a sorted list of tuples (scope, metric, value)"""
+        metrics = collections.defaultdict(dict)
+        for scope, counters in self.metrics.items():
+            metrics[scope].update(counters)
+        metrics['run']['max_loop_depth'] = self.max_depth
+        cache = metrics.get('cache')
+        if cache:
+            lookups = cache.get('hits', 0) + cache.get('misses', 0)
+            cache['hit_rate'] = cache.get('hits', 0) / lookups if lookups else 0.0
+        return [(scope, metric, value)
+                for scope in sorted(metrics)
+                for metric, value in sorted(metrics[scope].items())]
+
+    def report(self, path, fmt='json'):
+        """Write the statistics to a file
+        :param path: the path of the file
+        :param fmt: the format, 'json' or 'csv'
+        """
+        rows = self.rows()
+        with open(path, 'w', newline='') as f:
+            if fmt == 'csv':
+                writer = csv.writer(f)
+                writer.writerow(['scope', 'metric', 'value'])
+                writer.writerows(rows)
+            else:
+                report = collections.OrderedDict()
+                for scope, metric, value in rows:
+                    report.setdefault(scope, collections.OrderedDict())[metric] = value
+                json.dump(report, f, indent=2)
+                f.write('\n')
@@ -0,0 +1,148 @@
+# Software Name : aa-scan3
+# SPDX-FileCopyrightText: Copyright (c) 2020 Orange
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# This software is distributed under the GPLv2;
+# see the COPYING file for more details.
+#
+# Author: Yann E. MORIN <yann.morin@orange.com> et al.
+
+import functools
+import json
+import threading
+import time
+
+
+class AAtrace:
+    """Structured trace of the scans, as a list of events
+
+    Each event is a dict, with an 'ev' key that is either:
+
+    * 'step': a call to a plugin method, with the 'plugin', the 'phase'
+      (the name of the method), the 'file' it was called on, the 'time'
+      it took, and the number of files it 'yielded' for once() and scan();
+
+    * 'rule': a rule added to a profile, with the 'plugin' and 'phase'
+      that added it, the 'source' file that was being scanned, and the
+      'chain' of scanned files that led from the scanned executable to
+      that source file; its 'kind' is 'path', 'capability', 'network'
+      or 'profile' (a child profile), and the other keys depend on it.
+
+    All events also have the 'target', i.e. the scanned executable, and
+    rules of child profiles have the 'profile' they belong to.
+
+    Events are only recorded when enabled, by wrapping the methods of
+    the plugins, so that they cost nothing otherwise.
+    """
+    # Methods that may return generators, which must be consumed to time them
+    GENERATORS = {'once', 'scan'}
+
+    def __init__(self):
+        self.events = []
+        self.target = None
+        # Scans may run in several threads, each with its own current step
+        self.local = threading.local()
+        self.parents = dict()
+
+    @property
+    def current(self):
+        """:return: the (plugin, phase, file) of the step the current thread
+                    is running, or None
+        """
+        return getattr(self.local, 'current', None)
+
+    @current.setter
+    def current(self, step):
+        self.local.current = step
+
+    def start(self, target):
+        """Start tracing the scan of a new executable"""
+        self.target = target
+        self.current = None
+        # For each file, a tuple (depth, parent): the file that yielded it
+        self.parents = {target: (0, None)}
+
+    def wrap(self, plugin, phase, method):
+        """Wrap a plugin method, to trace its calls, and the rules it adds
+        :param plugin: the name of the plugin
+        :param phase: the name of the method, e.g. 'scan'
+        :param method: the bound method
+        :return: the wrapped method
+        """
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            path = args[0] if args else None
+            # Calls can nest, e.g. mangle() while adding a rule in scan()
+            previous, self.current = self.current, (plugin, phase, path)
+            ret = None
+            start = time.perf_counter()
+            try:
+                ret = method(*args, **kwargs)
+                if phase in AAtrace.GENERATORS and ret is not None:
+                    ret = list(ret)
+                return ret
+            finally:
+                elapsed = time.perf_counter() - start
+                self.current = previous
+                event = {'ev': 'step', 'target': self.target, 'plugin': plugin,
+                         'phase': phase, 'file': path, 'time': elapsed}
+                if phase in AAtrace.GENERATORS:
+                    event['yielded'] = len(ret or [])
+                    self.adopt(path, ret or [])
+                self.events.append(event)
+        return wrapper
+
+    def adopt(self, parent, files):
+        """Record the files yielded by a scan, keeping the shortest chain to
+        each of them; files are scanned in no particular order, so the first
+        parent in sorted order wins, for the trace to be reproducible.
+        """
+        depth = self.parents.get(parent, (0, None))[0] + 1
+        for f in files:
+            if f not in self.parents or (depth, parent) < self.parents[f]:
+                self.parents[f] = (depth, parent)
+
+    def rename(self, names):
+        """Record the files that were renamed before being scanned (e.g.
+        by a mangle plugin), to keep track of where they came from
+        :param names: a dict of the old names to the new ones
+        """
+        for old, new in names.items():
+            if old != new and old in self.parents:
+                self.parents.setdefault(new, self.parents[old])
+
+    def chain(self, path):
+        """:return: the list of the scanned files that led to path"""
+        chain = []
+        while path is not None and path not in chain:
+            chain.append(path)
+            path = self.parents.get(path, (0, None))[1]
+        return list(reversed(chain))
+
+    def rule(self, kind, child=None, **fields):
+        """Record a rule added to the profile
+        :param kind: 'path', 'capability', 'network' or 'profile'
+        :param child: the child profile the rule belongs to, if any
+        :param fields: the fields of the rule, e.g. path and mode
+        """
+        plugin, phase, source = self.current or (None, None, None)
+        event = {'ev': 'rule', 'target': self.target, 'kind': kind,
+                 'plugin': plugin, 'phase': phase, 'source': source,
+                 'chain': self.chain(source)}
+        if child is not None:
+            event['profile'] = child
+        event.update(fields)
+        self.events.append(event)
+
+    def take(self):
+        """Get the events recorded so far, and forget them
+        :return: the list of events
+        """
+        events, self.events = self.events, []
+        return events
+
+    @staticmethod
+    def write(f, events):
+        """Write events to a file, one compact JSON object per line"""
+        for event in events:
+            f.write(json.dumps(event, separators=(',', ':')) + '\n')
@@ -9,51 +9,181 @@
 
 import argparse
 import collections
+import contextlib
+import itertools
 import logging
+import os
 import pathlib
+import re
+import stat
 import sys
 
 
+def write_make_rule(f, target, prerequisites):
+    """Write a Make rule without recipe, e.g. for a depfile
+    :param f: the file to write to
+    :param target: the path of the target
+    :param prerequisites: the paths of its prerequisites
+    """
+    def escape(path):
+        return re.sub(r'([ #])', r'\\\1', path.replace('$', '$$'))
+    f.write('{}:'.format(escape(target)))
+    for p in prerequisites:
+        f.write(' \\\n  {}'.format(escape(p)))
+    f.write('\n')
+
+
+def write_if_changed(path, data):
+    """Write a file atomically, unless it already has that content, so
+    that its modification time is only updated when it changed
+    :param path: the path of the file
+    :param data: the content to write, as a string
+    :return: True if the file was written, False if it was unchanged
+    """
+    data = data.encode()
+    try:
+        st = os.stat(path)
+        if st.st_size == len(data):
+            with open(path, 'rb') as f:
+                if f.read() == data:
+                    return False
+    except FileNotFoundError:
+        st = None
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        if st is not None:
+            os.chmod(tmp, stat.S_IMODE(st.st_mode))
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+    return True
+
+
 class AAprofile:
-    X_MOD = set('pPcCuUi')
+    """The rules of a profile
 
-    def __init__(self, path, path_filter):
+    Modes are stored as bitmasks, one bit per mode character, so adding
+    a rule for a path that is already allowed is a couple of bit
+    operations. Mode characters are given their bit the first time they
+    are seen, so any mode character is accepted.
+    """
+    __slots__ = ('path', 'filter', 'trace', 'paths', 'capabilities', 'networks',
+                 'current_child', 'children')
+
+    X_MOD = set('pPcCuUi')
+    # The mode characters, by bit, and the bits of the exec modes
+    CHARS = []
+    X_MASK = 0
+    # Memoized conversions, from mode strings to bitmasks and back
+    BITS = dict()
+    MODES = dict()
+
+    def __init__(self, path, path_filter, trace=None):
         self.path = path
         self.filter = path_filter
+        # Rules of the children are traced by their parent
+        self.trace = trace
         self.paths = dict()
         self.capabilities = set()
         self.networks = collections.defaultdict(set)
         self.current_child = None
         self.children = dict()
 
+    @staticmethod
+    def mode_bits(mode):
+        """:return: the bitmask of a mode string, e.g. 'mr'"""
+        try:
+            return AAprofile.BITS[mode]
+        except KeyError:
+            pass
+        bits = 0
+        for c in mode:
+            if c not in AAprofile.CHARS:
+                AAprofile.CHARS.append(c)
+                if c in AAprofile.X_MOD:
+                    AAprofile.X_MASK |= 1 << (len(AAprofile.CHARS) - 1)
+            bits |= 1 << AAprofile.CHARS.index(c)
+        AAprofile.BITS[mode] = bits
+        return bits
+
+    @staticmethod
+    def mode_strings(bits):
+        """:return: a tuple (exec, other) of the mode strings of a bitmask,
+        either of which may be empty
+        """
+        try:
+            return AAprofile.MODES[bits]
+        except KeyError:
+            pass
+        chars = sorted(c for i, c in enumerate(AAprofile.CHARS) if bits & (1 << i))
+        x = ''.join(c for c in chars if c in AAprofile.X_MOD)
+        m = ''.join(c for c in chars if c not in AAprofile.X_MOD and c != 'x')
+        AAprofile.MODES[bits] = (x + 'x' if x else '', m)
+        return AAprofile.MODES[bits]
+
     def get_path(self):
         return self.filter(self.path)
 
     def add_path(self, path, mode):
+        if self.trace is not None:
+            _path = self.filter(path)
+            self.trace.rule('path', self.current_child, path=_path or None, raw=path, mode=mode,
+                            dropped=not _path)
         if self.current_child:
             self.children[self.current_child].add_path(path, mode)
         else:
             path = self.filter(path)
             if not path: return  # noqa: E701
-            try:
-                old_x = set(self.paths[path]) & AAprofile.X_MOD
-                new_x = set(mode) & AAprofile.X_MOD
-                if len(old_x ^ new_x) > 1:
-                    raise ValueError('Adding new executable mode {}, while {} already used'.format(new_x,
-                                                                                                   old_x))
-                logging.debug('Updating {} with new mode {}'.format(path, mode))
-                self.paths[path] += mode
-            except KeyError:
-                logging.debug('Adding {} with mode {}'.format(path, mode))
-                self.paths[path] = mode
+            if self.add_bits(path, AAprofile.mode_bits(mode)):
+                logging.debug('Updating %s with new mode %s', path, mode)
+            else:
+                logging.debug('Adding %s with mode %s', path, mode)
+
+    def add_bits(self, path, bits):
+        """Add a rule for an already filtered path
+        :return: True if there already was a rule for that path
+        """
+        old = self.paths.get(path)
+        if old is None:
+            self.paths[sys.intern(path)] = bits
+            return False
+        if bin((old ^ bits) & AAprofile.X_MASK).count('1') > 1:
+            raise ValueError('Adding new executable mode {}, while {} already used'.format(
+                             set(AAprofile.mode_strings(bits & AAprofile.X_MASK)[0][:-1]),
+                             set(AAprofile.mode_strings(old & AAprofile.X_MASK)[0][:-1])))
+        self.paths[path] = old | bits
+        return True
+
+    def merge(self, other):
+        """Add the rules of another profile to this one; its paths are
+        already filtered, so they are not filtered again
+        :param other: the other AAprofile
+        """
+        for path, bits in other.paths.items():
+            self.add_bits(path, bits)
+        self.capabilities |= other.capabilities
+        for domain, protocols in other.networks.items():
+            self.networks[domain] |= protocols
+        for path, child in other.children.items():
+            if path not in self.children:
+                self.children[path] = AAprofile(path, self.filter)
+            self.children[path].merge(child)
 
     def add_capability(self, capability):
+        if self.trace is not None:
+            self.trace.rule('capability', self.current_child, capability=capability)
         if self.current_child:
             self.children[self.current_child].add_capability(capability)
         else:
             self.capabilities.add(capability)
 
     def add_network(self, domain, protocol):
+        if self.trace is not None:
+            self.trace.rule('network', self.current_child, domain=domain, protocol=protocol)
         if self.current_child:
             self.children[self.current_child].add_network(domain, protocol)
         else:
@@ -65,6 +195,8 @@ class AAprofile:
                                  + ' trying to add {} while handling {}'.format(self.current_child,
                                                                                 path))
         self.current_child = path
+        if self.trace is not None:
+            self.trace.rule('profile', path=path)
         if path not in self.children:
             self.children[path] = AAprofile(path, self.filter)
 
@@ -74,13 +206,12 @@ class AAprofile:
         self.current_child = None
 
     def get_paths(self):
-        for p in self.paths:
-            x = set(self.paths[p]) & AAprofile.X_MOD
+        for p, bits in self.paths.items():
+            x, m = AAprofile.mode_strings(bits)
             if x:
-                yield (p, '{}x'.format(''.join(x)))
-            m = set(self.paths[p]) - (AAprofile.X_MOD | {'x'})
+                yield (p, x)
             if m:
-                yield (p, ''.join(sorted(m)))
+                yield (p, m)
 
     def get_capabilities(self):
         for cap in self.capabilities:
@@ -106,6 +237,260 @@ class AAprofile:
         return str(p)
 
 
+class AApathfilter:
+    """Transform paths with a chain of plugin methods (e.g. their mangle()
+    methods), then squash repeated slashes.
+
+    Results are memoized, so that each distinct path only goes through the
+    plugins once, until clear() is called, e.g. when the state of the
+    plugins changed. When more than max_size results are memoized, the
+    oldest half is forgotten.
+    """
+    MAX_SIZE = 1 << 16
+    SLASHES = re.compile('/+')
+
+    def __init__(self, name, steps, max_size=MAX_SIZE):
+        """
+        :param name: the name of the plugin method, for logging
+        :param steps: a list of tuples (plugin, method), applied in order
+        :param max_size: the maximum number of memoized results
+        """
+        self.name = name
+        self.steps = steps
+        self.max_size = max_size
+        self.raw_results = dict()
+        self.results = dict()
+        self.busy = 0
+
+    def __call__(self, path):
+        try:
+            return self.results[path]
+        except KeyError:
+            pass
+        _path = self.raw(path)
+        if _path:
+            # Interned, as the same paths end up in many profiles
+            _path = sys.intern(AApathfilter.SLASHES.sub('/', _path))
+        if not self.busy:
+            self._store(self.results, path, _path)
+        return _path
+
+    def raw(self, path):
+        """Like calling the filter, but without squashing repeated slashes
+        :param path: the path to transform
+        :return: the transformed path
+        """
+        try:
+            return self.raw_results[path]
+        except KeyError:
+            pass
+        # A plugin may need another path to transform this one (e.g. the
+        # path of the profile); that one is not final yet, so not memoized.
+        busy = self.busy
+        self.busy += 1
+        try:
+            _path = path
+            for plugin, step in self.steps:
+                logging.debug('Running %s.%s on %s', plugin, self.name, _path)
+                _p = step(_path)
+                if _p != _path:
+                    logging.debug('Replacing %s with %s', _path, _p)
+                _path = _p
+        finally:
+            self.busy -= 1
+        if not busy:
+            _path = sys.intern(_path)
+            self._store(self.raw_results, path, _path)
+        return _path
+
+    def clear(self):
+        self.raw_results.clear()
+        self.results.clear()
+
+    def _store(self, results, path, value):
+        if len(results) >= self.max_size:
+            for p in list(itertools.islice(results, self.max_size // 2)):
+                del results[p]
+        results[path] = value
+
+
+class AAtree:
+    """Index of a directory tree, that lists each directory at most once,
+    the first time it is looked into, and expands AppArmor globs.
+
+    Globs support the '*', '**', '?', '[...]' and '{a,b}' constructs. The
+    '**' stem only matches arbitrarily deep directory components, and does
+    not follow symbolic links to directories; e.g. '/foo/**/*.bar' finds
+    the files named '*.bar' in '/foo' and its sub-directories, while
+    '/foo/**.bar' only finds directories.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.dirs = dict()
+        self.listed = None
+
+    def listdir(self, path, record=True):
+        """List a directory
+        :param path: the path of the directory, relative to the root
+        :param record: whether to record it, see recording(); not when
+                       only looking up an entry of it
+        :return: a dict of names to tuples (is_dir, is_file, is_symlink),
+                 where is_dir and is_file follow symbolic links; empty if
+                 path is not a directory
+        """
+        if record and self.listed is not None:
+            self.listed.add(path)
+        if path not in self.dirs:
+            entries = dict()
+            try:
+                # Not a context manager, which needs python 3.6
+                for entry in os.scandir(os.path.join(self.root, path.lstrip('/'))):
+                    entries[entry.name] = (entry.is_dir(), entry.is_file(), entry.is_symlink())
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                pass
+            self.dirs[path] = entries
+        return self.dirs[path]
+
+    @contextlib.contextmanager
+    def recording(self, listed):
+        """Record the directories whose entries were matched, e.g. by
+        glob(), even if they were already listed; not the ones a path was
+        only looked up in, nor the ones leading to a pattern, nor the roots
+        of walk()
+        :param listed: the set to add the paths of the directories to
+        """
+        previous, self.listed = self.listed, listed
+        try:
+            yield listed
+        finally:
+            self.listed = previous
+
+    def lookup(self, path):
+        """:return: a tuple (is_dir, is_file, is_symlink), or None if
+                    path does not exist
+        """
+        if path == '/':
+            return (True, False, False)
+        d, name = path.rstrip('/').rsplit('/', 1)
+        return self.listdir(d or '/', False).get(name)
+
+    def is_file(self, path):
+        entry = self.lookup(path)
+        return entry is not None and entry[1]
+
+    def glob(self, pattern):
+        """Expand an AppArmor glob
+        :param pattern: the glob, relative to the root
+        :return: the list of matching paths, relative to the root
+        """
+        found = collections.OrderedDict()
+        for p in AAtree.expand_braces(pattern):
+            for path in self._match('/', [c for c in p.split('/') if c]):
+                found[path] = None
+        return list(found)
+
+    def walk(self, path, root=True):
+        """Iterate over a directory and its sub-directories, recursively,
+        without following symbolic links to directories; the directory
+        itself is not recorded, see recording()
+        """
+        yield path
+        for name, (is_dir, _, is_symlink) in self.listdir(path, not root).items():
+            if is_dir and not is_symlink:
+                yield from self.walk(os.path.join(path, name), False)
+
+    def _match(self, path, components):
+        if not components:
+            yield path
+            return
+        comp, rest = components[0], components[1:]
+        if comp == '**':
+            for d in self.walk(path):
+                yield from self._match(d, rest)
+        elif '**' in comp:
+            regex = re.compile(AAtree.translate(comp) + '$')
+            for d in self.walk(path):
+                if d != path and regex.match(os.path.relpath(d, path)):
+                    yield from self._match(d, rest)
+        elif any(c in comp for c in '*?[\\'):
+            regex = re.compile(AAtree.translate(comp) + '$')
+            for name, (is_dir, _, _) in self.listdir(path).items():
+                if (is_dir or not rest) and regex.match(name):
+                    yield from self._match(os.path.join(path, name), rest)
+        else:
+            entry = self.listdir(path, False).get(comp)
+            if entry is not None and (entry[0] or not rest):
+                yield from self._match(os.path.join(path, comp), rest)
+
+    @staticmethod
+    def expand_braces(pattern):
+        """Expand the (possibly nested) '{a,b}' alternations of a glob
+        :return: a list of globs without alternations
+        """
+        depth = 0
+        start = None
+        commas = []
+        i = 0
+        while i < len(pattern):
+            c = pattern[i]
+            if c == '\\':
+                i += 1
+            elif c == '{':
+                if depth == 0:
+                    start = i
+                depth += 1
+            elif c == ',' and depth == 1:
+                commas.append(i)
+            elif c == '}' and depth > 0:
+                depth -= 1
+                if depth == 0:
+                    bounds = [start] + commas + [i]
+                    alternatives = [pattern[bounds[n]+1:bounds[n+1]] for n in range(len(bounds) - 1)]
+                    return [p
+                            for alt in alternatives
+                            for p in AAtree.expand_braces(pattern[:start] + alt + pattern[i+1:])]
+            i += 1
+        return [pattern]
+
+    @staticmethod
+    def translate(pattern):
+        """Translate a glob to a regexp, where '**' matches across '/'"""
+        res = []
+        i = 0
+        while i < len(pattern):
+            c = pattern[i]
+            i += 1
+            if c == '*':
+                if pattern[i:i+1] == '*':
+                    res.append('.*')
+                    i += 1
+                else:
+                    res.append('[^/]*')
+            elif c == '?':
+                res.append('[^/]')
+            elif c == '[':
+                j = i
+                if pattern[j:j+1] in ('^', '!'):
+                    j += 1
+                if pattern[j:j+1] == ']':
+                    j += 1
+                j = pattern.find(']', j)
+                if j < 0:
+                    res.append(re.escape(c))
+                else:
+                    cls = pattern[i:j].replace('\\', '\\\\')
+                    if cls[:1] == '!':
+                        cls = '^' + cls[1:]
+                    res.append('[{}]'.format(cls))
+                    i = j + 1
+            elif c == '\\' and i < len(pattern):
+                res.append(re.escape(pattern[i]))
+                i += 1
+            else:
+                res.append(re.escape(c))
+        return ''.join(res)
+
+
 class AAScanArgParser(argparse.ArgumentParser):
     def __init__(self, *args, **kwargs):
         argparse.ArgumentParser.__init__(self,
@@ -214,6 +599,12 @@ class AAScanArgParser(argparse.ArgumentParser):
         return _ToggleAction
 
 
+class AAScanError(Exception):
+    """A scan that can not be completed, e.g. reported by a plugin with
+    logger.critical()
+    """
+
+
 class AALogger:
     def __init__(self, plugin):
         self.prefix = '{}: '.format(plugin)
@@ -235,4 +626,4 @@ class AALogger:
 
     def critical(self, msg, *args, **kwargs):
         logging.critical(self.prefix + msg, *args, **kwargs)
-        sys.exit(1)
+        raise AAScanError(self.prefix + msg % args if args else self.prefix + msg)
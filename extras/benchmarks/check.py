@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+# Software Name : aa-scan3
+# SPDX-FileCopyrightText: Copyright (c) 2020 Orange
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# This software is distributed under the GPLv2;
+# see the COPYING file for more details.
+#
+# Author: Yann E. MORIN <yann.morin@orange.com> et al.
+
+"""
+Check the optimised code paths against their reference, on a synthetic
+target (see rootfs.py) and on the files of the host:
+
+  * the compiled RuleSet of the replace plugin, against applying each
+    substitution in turn (see replace_rules.py);
+
+  * the DT_NEEDED entries read by ELFReader, against pyelftools (see
+    elf_needed.py);
+
+  * the resources the qrc plugin parses from qrc files, against
+    'rcc --list', when rcc is available;
+
+  * the rules folded by the compactor with a threshold of 0, against
+    the rules it folded, so it never widens a profile;
+
+  * the profiles generated with threads, against the ones generated
+    with a single thread.
+
+Each check asserts that they agree; the exit code is 1 when one does not.
+"""
+
+import argparse
+import collections
+import os
+import random
+import shutil
+import sys
+import tempfile
+import traceback
+
+import elf_needed
+import replace_rules
+import rootfs
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+import aa_scan3  # noqa: E402
+import aa_scan3.compact  # noqa: E402
+import aa_scan3.plugins  # noqa: E402
+import aa_scan3.utils  # noqa: E402
+
+# Resources of the qrc files checked against rcc, relative to the qrc
+QRC_FILES = ['main.qml', 'img/a.png', 'img/.hidden.png', 'img/sub/b.png', 'js/c.js']
+QRC = '''<!DOCTYPE RCC><RCC version="1.0">
+<qresource>
+    <file>main.qml</file>
+    <file alias="script.js">js/c.js</file>
+</qresource>
+<qresource prefix="/images/">
+    <file>img</file>
+    <file alias="b.png">img/sub/b.png</file>
+</qresource>
+</RCC>
+'''
+
+
+def check_replace(args, target):
+    rnd = random.Random(args.seed)
+    rules = [replace_rules.replace.parse_sed(r) for r in replace_rules.gen_rules(args.rules, rnd)]
+    paths = replace_rules.gen_paths(args.paths, args.rules, rnd)
+    compiled = replace_rules.compiled(rules, paths)
+    naive = replace_rules.naive(rules, paths)
+    for p, c, n in zip(paths, compiled, naive):
+        assert c == n, '{}: {!r} != {!r}'.format(p, c, n)
+    return '{} paths, {} substitutions'.format(len(paths), len(rules))
+
+
+def check_elf(args, target):
+    files = []
+    for f in elf_needed.corpus([os.path.join(target, 'root')] + args.elf_paths):
+        try:
+            with open(f, 'rb') as fd:
+                if fd.read(4) == b'\x7fELF':
+                    files.append(f)
+        except OSError:
+            continue
+        if len(files) >= args.max_files:
+            break
+    for f in files:
+        fast, slow = elf_needed.needed_elfreader(f), elf_needed.needed_pyelftools(f)
+        assert fast == slow, '{}: {!r} != {!r}'.format(f, fast, slow)
+    return '{} ELF files'.format(len(files))
+
+
+def check_qrc(args, target):
+    rcc = args.rcc or shutil.which('rcc')
+    if rcc is None:
+        return 'skipped, no rcc'
+    qrc_dir = os.path.join(target, 'qrc-check')
+    for f in QRC_FILES:
+        rootfs.write(os.path.join(qrc_dir, f), f + '\n')
+    rootfs.write(os.path.join(qrc_dir, 'check.qrc'), QRC)
+
+    qrc = aa_scan3.plugins.plugins['qrc'].module.Scanner(argparse.ArgumentParser())
+    qrc.rcc = rcc
+    qrc.counters = collections.Counter()
+    path = os.path.join(qrc_dir, 'check.qrc')
+    parsed = [f for _, f in qrc.parse_qrc(path)]
+    listed = qrc.rcc_list(path)
+    assert parsed == listed, '{!r} != {!r}'.format(parsed, listed)
+    return '{} resources'.format(len(parsed))
+
+
+def folded_rules(plain, compacted, tree):
+    """Check that the rules of a compacted profile allow the same files
+    as the ones of the profile it was compacted from
+    :return: the number of glob rules added
+    """
+    globs = 0
+    covered = set()
+    for path, bits in compacted.paths.items():
+        if path in plain.paths or not aa_scan3.compact.AAcompactor.GLOB_CHARS.search(path):
+            assert plain.paths.get(path) == bits, '{}: {} rule changed'.format(compacted.path, path)
+            continue
+        globs += 1
+        pattern = path + '/*' if path.endswith('**') else path
+        for f in tree.glob(pattern):
+            if tree.is_file(f):
+                assert plain.paths.get(f, 0) & bits == bits, \
+                    '{}: {} newly allows {}'.format(compacted.path, path, f)
+                covered.add(f)
+    for path in plain.paths:
+        assert path in compacted.paths or path in covered, \
+            '{}: {} is no longer allowed'.format(compacted.path, path)
+    children = {c.path: c for c in plain.get_children()}
+    for c in compacted.get_children():
+        globs += folded_rules(children[c.path], c, tree)
+    return globs
+
+
+def check_compact(args, target, options, binaries):
+    tree = aa_scan3.utils.AAtree(options['root_dir'])
+    globs = 0
+    with aa_scan3.AAscanner(**options) as plain, \
+            aa_scan3.AAscanner(compact=True, compact_threshold=0, **options) as compacted:
+        for b in binaries:
+            globs += folded_rules(plain.scan(b), compacted.scan(b), tree)
+    return '{} glob rules'.format(globs)
+
+
+def check_threads(args, target, options, binaries):
+    with aa_scan3.AAscanner(**options) as serial, \
+            aa_scan3.AAscanner(scan_threads=args.threads, **options) as threaded:
+        for b in binaries:
+            one, many = serial.render(serial.scan(b)), threaded.render(threaded.scan(b))
+            assert one == many, '{}: profiles differ'.format(b)
+    return '{} profiles, {} threads'.format(len(binaries), args.threads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random generators')
+    parser.add_argument('--rules', type=int, default=300,
+                        help='Number of substitutions')
+    parser.add_argument('--paths', type=int, default=2000,
+                        help='Number of paths to apply the substitutions to')
+    parser.add_argument('--max-files', type=int, default=500,
+                        help='Maximum number of ELF files')
+    parser.add_argument('--elf-paths', metavar='PATH', nargs='*',
+                        default=['/usr/bin', '/usr/lib'],
+                        help='Files, or directories to scan for ELF files, besides the'
+                        + ' synthetic target')
+    parser.add_argument('--rcc', metavar='RCC',
+                        help='The rcc to check qrc files against. Default: rcc, if'
+                        + ' found in PATH')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='Number of threads to compare to a single one')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='aa-scan3-check-')
+    failed = False
+    try:
+        target = os.path.join(work_dir, 'target')
+        argv = rootfs.generate(target, seed=args.seed, binaries=10, modules=10)
+        options = {
+            'root_dir': os.path.join(target, 'root'),
+            'staging_dir': os.path.join(target, 'staging'),
+            'plugin_options': {
+                'elf': {'lib_dirs': argv[argv.index('--elf-lib-dirs') + 1]},
+                'qrc': {'rcc': argv[argv.index('--qrc-rcc') + 1],
+                        'pattern': argv[argv.index('--qrc-pattern') + 1],
+                        'base_dir': argv[argv.index('--qrc-base-dir') + 1]},
+                'snippet': {'expand_wildcards': True},
+            },
+        }
+        with open(os.path.join(target, 'manifest'), 'r') as f:
+            binaries = f.read().split()
+
+        checks = [
+            ('replace', lambda: check_replace(args, target)),
+            ('elf', lambda: check_elf(args, target)),
+            ('qrc', lambda: check_qrc(args, target)),
+            ('compact', lambda: check_compact(args, target, options, binaries)),
+            ('threads', lambda: check_threads(args, target, options, binaries)),
+        ]
+        for name, check in checks:
+            try:
+                print('{:<8} ok: {}'.format(name, check()))
+            except AssertionError:
+                failed = True
+                print('{:<8} FAILED: {}'.format(name, traceback.format_exc().strip().splitlines()[-1]))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
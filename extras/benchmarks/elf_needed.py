@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# Software Name : aa-scan3
+# SPDX-FileCopyrightText: Copyright (c) 2020 Orange
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# This software is distributed under the GPLv2;
+# see the COPYING file for more details.
+#
+# Author: Yann E. MORIN <yann.morin@orange.com> et al.
+
+"""
+Compare the time it takes to get the DT_NEEDED entries of a corpus of
+ELF files, with the mmap-based ELFReader and with pyelftools, and check
+that both agree.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import elftools.elf.elffile as ELF
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+import aa_scan3.elfutils  # noqa: E402
+
+
+def needed_elfreader(path):
+    try:
+        with aa_scan3.elfutils.ELFReader(path) as elf:
+            return elf.needed()
+    except aa_scan3.elfutils.NotELFError:
+        return None
+
+
+def needed_pyelftools(path):
+    with open(path, 'rb') as f:
+        try:
+            elf = ELF.ELFFile(f)
+        except ELF.ELFError:
+            return None
+        s = elf.get_section_by_name('.dynamic')
+        if not s:
+            # Without section headers (e.g. the files of rootfs.py), like ELFReader
+            s = next((p for p in elf.iter_segments() if p['p_type'] == 'PT_DYNAMIC'), None)
+        if not s:
+            return []
+        return [t.needed for t in s.iter_tags() if t.entry.d_tag == 'DT_NEEDED']
+
+
+def corpus(paths):
+    for p in paths:
+        if os.path.isdir(p):
+            for dirpath, _, filenames in os.walk(p):
+                for f in sorted(filenames):
+                    f = os.path.join(dirpath, f)
+                    if os.path.isfile(f) and not os.path.islink(f):
+                        yield f
+        elif os.path.isfile(p):
+            yield p
+
+
+def bench(reader, files, rounds):
+    results = dict()
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for f in files:
+            try:
+                results[f] = reader(f)
+            except Exception as e:
+                results[f] = e
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='Number of rounds; the best one is reported')
+    parser.add_argument('--max-files', type=int, default=2000,
+                        help='Maximum number of files in the corpus')
+    parser.add_argument('paths', metavar='PATH', nargs='*',
+                        default=['/usr/bin', '/usr/lib'],
+                        help='Files, or directories to scan for files')
+    args = parser.parse_args()
+
+    files = []
+    for f in corpus(args.paths):
+        try:
+            with open(f, 'rb') as fd:
+                if fd.read(4) == b'\x7fELF':
+                    files.append(f)
+        except OSError:
+            continue
+        if len(files) >= args.max_files:
+            break
+    size = sum(os.path.getsize(f) for f in files)
+    print('corpus: {} ELF files, {:.1f} MiB'.format(len(files), size / (1 << 20)))
+
+    fast, fast_res = bench(needed_elfreader, files, args.rounds)
+    slow, slow_res = bench(needed_pyelftools, files, args.rounds)
+    print('ELFReader:  {:8.3f}s'.format(fast))
+    print('pyelftools: {:8.3f}s'.format(slow))
+    print('speedup:    {:8.1f}x'.format(slow / fast if fast else float('inf')))
+
+    mismatches = [f for f in files if fast_res[f] != slow_res[f]]
+    for f in mismatches:
+        print('mismatch: {}: {!r} != {!r}'.format(f, fast_res[f], slow_res[f]))
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
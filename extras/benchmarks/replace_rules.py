@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# Software Name : aa-scan3
+# SPDX-FileCopyrightText: Copyright (c) 2020 Orange
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# This software is distributed under the GPLv2;
+# see the COPYING file for more details.
+#
+# Author: Yann E. MORIN <yann.morin@orange.com> et al.
+
+"""
+Compare the time it takes to apply a large set of substitutions to a
+large set of paths, with the compiled RuleSet of the replace plugin and
+with applying each substitution in turn, and check that they agree.
+Applying each substitution in turn is so slow that it is only done on
+a sample of the paths; its time is extrapolated to all the paths.
+
+The substitutions mimic the ones generated from a partition layout:
+mostly anchored prefixes, some unanchored directory renames, and a few
+without any literal prefix.
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+import aa_scan3.plugins  # noqa: E402
+
+replace = aa_scan3.plugins.plugins['replace'].module
+
+
+def gen_rules(n, rnd):
+    rules = []
+    for i in range(n):
+        kind = rnd.random()
+        if kind < 0.8:
+            rules.append('s,^/part{0}/,/mnt/p{0}/,'.format(i))
+        elif kind < 0.98:
+            rules.append('s,/lib{0}/,/usr/lib{0}/,'.format(i))
+        else:
+            rules.append('s,[.]so[.]{0}$,.so.{0}*,'.format(i))
+    return rules
+
+
+def gen_paths(n, n_rules, rnd):
+    dirs = ['etc', 'usr', 'lib', 'data', 'opt']
+    paths = []
+    for _ in range(n):
+        kind = rnd.random()
+        if kind < 0.5:
+            top = 'part{}'.format(rnd.randrange(n_rules * 2))
+        else:
+            top = rnd.choice(dirs)
+        mid = 'lib{}'.format(rnd.randrange(n_rules * 2)) if rnd.random() < 0.3 else rnd.choice(dirs)
+        paths.append('/{}/{}/file{}.so.{}'.format(top, mid, rnd.randrange(1000), rnd.randrange(n_rules)))
+    return paths
+
+
+def naive(rules, paths):
+    # Like the replace plugin used to do; with more substitutions than
+    # the re module caches, each is compiled again for each path.
+    out = []
+    for path in paths:
+        for r, repl in rules:
+            path = re.sub(r, repl, path)
+        out.append(path)
+    return out
+
+
+def precompiled(rules, paths):
+    rules = [(re.compile(r), repl) for r, repl in rules]
+    out = []
+    for path in paths:
+        for r, repl in rules:
+            path = r.sub(repl, path)
+        out.append(path)
+    return out
+
+
+def compiled(rules, paths):
+    ruleset = replace.RuleSet(rules)
+    return [ruleset.apply(path) for path in paths]
+
+
+def bench(func, rules, paths):
+    start = time.perf_counter()
+    out = func(rules, paths)
+    return time.perf_counter() - start, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rules', type=int, default=1000,
+                        help='Number of substitutions')
+    parser.add_argument('--paths', type=int, default=100000,
+                        help='Number of paths')
+    parser.add_argument('--sample', type=int, default=200,
+                        help='Number of paths to apply each substitution in turn to')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random generator')
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    rules = [replace.parse_sed(r) for r in gen_rules(args.rules, rnd)]
+    paths = gen_paths(args.paths, args.rules, rnd)
+    print('{} substitutions, {} paths'.format(len(rules), len(paths)))
+
+    fast, fast_out = bench(compiled, rules, paths)
+    print('RuleSet:                 {:8.3f}s'.format(fast))
+
+    mismatches = []
+    sample = paths[:args.sample]
+    scale = len(paths) / len(sample)
+    for name, func in [('sequential', naive), ('sequential, precompiled', precompiled)]:
+        slow, slow_out = bench(func, rules, sample)
+        print('{:<24} {:8.3f}s (extrapolated from {} paths), speedup {:.1f}x'.format(
+              name + ':', slow * scale, len(sample), slow * scale / fast if fast else float('inf')))
+        mismatches.extend((p, f, s) for p, f, s in zip(sample, fast_out, slow_out) if f != s)
+
+    for p, f, s in mismatches[:10]:
+        print('mismatch: {}: {!r} != {!r}'.format(p, f, s))
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
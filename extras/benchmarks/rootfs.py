@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+# Software Name : aa-scan3
+# SPDX-FileCopyrightText: Copyright (c) 2020 Orange
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# This software is distributed under the GPLv2;
+# see the COPYING file for more details.
+#
+# Author: Yann E. MORIN <yann.morin@orange.com> et al.
+
+"""
+Generate a synthetic target, to benchmark aa-scan3 on:
+
+  * a root directory, with executables and libraries, whose DT_NEEDED
+    form chains of configurable depth and fan-out, and Qt-style qml
+    modules, with qmldir files, plugins, and qml files importing other
+    modules;
+
+  * a staging directory, with snippets for the executables;
+
+  * a source directory, with the qrc files the executables embed the
+    path of, and the qml files they list;
+
+  * a stand-in for 'rcc --list', and a manifest listing the executables.
+
+The generated tree only depends on the parameters and the seed.
+"""
+
+import argparse
+import os
+import random
+import struct
+import sys
+
+PATTERN = 'AASCANBENCHQRC'
+
+DEFAULTS = {
+    'binaries': 20,         # number of executables
+    'depth': 4,             # levels of libraries below the executables
+    'fanout': 3,            # DT_NEEDED of each executable and library
+    'libs': 10,             # libraries per level
+    'modules': 20,          # number of qml modules
+    'types': 5,             # qml types per module
+    'imports': 3,           # modules imported by each qml file
+    'qrc': 0.5,             # ratio of executables that embed a qrc
+    'snippets': 0.5,        # ratio of executables that have a snippet
+}
+
+RCC = '''#!/usr/bin/env python3
+# Stand-in for 'rcc --list', for the qrc files of the benchmarks
+import os
+import sys
+import xml.etree.ElementTree as ET
+qrc = sys.argv[2]
+qrc_dir = os.path.dirname(os.path.abspath(qrc))
+for f in ET.parse(qrc).getroot().iter('file'):
+    print(os.path.normpath(os.path.join(qrc_dir, f.text.strip())))
+'''
+
+
+def elf(needed, extra=b''):
+    """Build a minimal 64-bit little-endian ELF shared object
+    :param needed: the DT_NEEDED entries
+    :param extra: data appended to the file, e.g. qrc markers
+    :return: the content of the file
+    """
+    ehdr_size, phdr_size, dyn_size = 64, 56, 16
+    strtab = b'\x00'
+    offsets = []
+    for n in needed:
+        offsets.append(len(strtab))
+        strtab += n.encode() + b'\x00'
+    dyn_off = ehdr_size + 2 * phdr_size
+    dyn = [(1, o) for o in offsets] + [(5, 0), (10, len(strtab)), (0, 0)]
+    str_off = dyn_off + len(dyn) * dyn_size
+    dyn[-3] = (5, str_off)
+    size = str_off + len(strtab) + len(extra)
+
+    data = b'\x7fELF' + bytes([2, 1, 1, 0]) + b'\x00' * 8
+    data += struct.pack('<HHIQQQIHHHHHH', 3, 62, 1, 0, ehdr_size, 0, 0,
+                        ehdr_size, phdr_size, 2, 64, 0, 0)
+    data += struct.pack('<IIQQQQQQ', 1, 5, 0, 0, 0, size, size, 0x1000)
+    data += struct.pack('<IIQQQQQQ', 2, 6, dyn_off, dyn_off, dyn_off,
+                        len(dyn) * dyn_size, len(dyn) * dyn_size, 8)
+    data += b''.join(struct.pack('<qQ', t, v) for t, v in dyn)
+    return data + strtab + extra
+
+
+def write(path, data, mode=0o644):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+    os.chmod(path, mode)
+
+
+def generate(out, seed=0, **params):
+    """Generate a synthetic target
+    :param out: the directory to generate the target in
+    :param seed: the seed of the random generator
+    :param params: overrides of DEFAULTS
+    :return: the list of arguments to pass to aa-scan3
+    """
+    p = dict(DEFAULTS, **params)
+    rnd = random.Random(seed)
+    out = os.path.abspath(out)
+    root = os.path.join(out, 'root')
+    staging = os.path.join(out, 'staging')
+    src = os.path.join(out, 'src')
+
+    # Libraries, by level; the last level needs nothing
+    levels = [['libbench{}_{}.so.1'.format(d, i) for i in range(p['libs'])]
+              for d in range(p['depth'])]
+    for d, level in enumerate(levels):
+        for lib in level:
+            needed = rnd.sample(levels[d+1], min(p['fanout'], p['libs'])) if d+1 < len(levels) else []
+            write(os.path.join(root, 'usr/lib', lib), elf(needed + ['libc.so.6']))
+    write(os.path.join(root, 'lib/libc.so.6'), elf([]))
+    top = levels[0] if levels else []
+
+    # qml modules, each with a plugin and qml types importing other modules
+    modules = ['Bench.Mod{}'.format(i) for i in range(p['modules'])]
+    for i, mod in enumerate(modules):
+        mod_dir = os.path.join(root, 'usr/lib/qml', mod.replace('.', '/'))
+        qmldir = ['module {}'.format(mod), 'plugin mod{}plugin'.format(i)]
+        for t in range(p['types']):
+            qmldir.append('Type{0} 1.0 Type{0}.qml'.format(t))
+            # Only import modules with a higher index, so there is no cycle
+            imports = rnd.sample(modules[i+1:], min(p['imports'], len(modules) - i - 1))
+            write(os.path.join(mod_dir, 'Type{}.qml'.format(t)),
+                  ''.join('import {} 1.0\n'.format(m) for m in imports) + 'Item {}\n')
+        write(os.path.join(mod_dir, 'qmldir'), '\n'.join(qmldir) + '\n')
+        write(os.path.join(mod_dir, 'libmod{}plugin.so'.format(i)),
+              elf(rnd.sample(top, min(1, len(top))) + ['libc.so.6']))
+
+    # Executables, with their qrc and snippets
+    binaries = []
+    for i in range(p['binaries']):
+        name = 'bench{}'.format(i)
+        extra = b''
+        if rnd.random() < p['qrc'] and modules:
+            qrc = os.path.join(src, name, name + '.qrc')
+            imports = rnd.sample(modules, min(p['imports'], len(modules)))
+            write(os.path.join(src, name, 'main.qml'),
+                  ''.join('import {} 1.0\n'.format(m) for m in imports) + 'Item {}\n')
+            write(qrc, '<!DOCTYPE RCC><RCC version="1.0">\n<qresource prefix="/">\n'
+                  + '    <file>main.qml</file>\n</qresource>\n</RCC>\n')
+            extra = '\n{}:{}\x00'.format(PATTERN, qrc).encode()
+        write(os.path.join(root, 'usr/bin', name),
+              elf(rnd.sample(top, min(p['fanout'], len(top))) + ['libc.so.6'], extra), 0o755)
+        if rnd.random() < p['snippets']:
+            write(os.path.join(staging, 'usr/bin', name + '.aa'),
+                  '/etc/{}.conf r,\n/usr/lib/qml/**/*.so mr,\ncapability net_admin,\n'.format(name))
+        binaries.append('/usr/bin/' + name)
+
+    # aa-scan3 wants those, even if empty
+    os.makedirs(staging, exist_ok=True)
+    os.makedirs(root, exist_ok=True)
+    write(os.path.join(out, 'manifest'), ''.join(b + '\n' for b in binaries))
+    write(os.path.join(out, 'rcc'), RCC, 0o755)
+
+    return ['--root-dir', root, '--staging-dir', staging,
+            '--manifest', os.path.join(out, 'manifest'),
+            '--elf-lib-dirs', '/lib,/usr/lib',
+            '--qrc-rcc', os.path.join(out, 'rcc'),
+            '--qrc-pattern', PATTERN,
+            '--qrc-base-dir', '/usr/lib/qml',
+            '--snippet-expand-wildcards']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random generator')
+    for k, v in DEFAULTS.items():
+        parser.add_argument('--' + k, type=type(v), default=v,
+                            help='[default: {}]'.format(v))
+    parser.add_argument('out', metavar='DIR',
+                        help='The directory to generate the target in')
+    args = parser.parse_args()
+
+    argv = generate(args.out, args.seed, **{k: getattr(args, k) for k in DEFAULTS})
+    print(' '.join(argv))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
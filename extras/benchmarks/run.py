@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+# Software Name : aa-scan3
+# SPDX-FileCopyrightText: Copyright (c) 2020 Orange
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# This software is distributed under the GPLv2;
+# see the COPYING file for more details.
+#
+# Author: Yann E. MORIN <yann.morin@orange.com> et al.
+
+"""
+Time aa-scan3 end to end, and per plugin, on synthetic targets (see
+rootfs.py), as each of their dimensions scales.
+
+Results are appended to a history file, and compared to the previous
+ones for the same scenario: a run is flagged as a regression when it is
+slower than the best of the previous runs by more than the threshold,
+or when the generated profiles are not byte-identical to the previous
+ones. The exit code is 1 when anything is flagged.
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import rootfs
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+# Each scenario scales one dimension of the target, the others keep their defaults
+SCENARIOS = {
+    'binaries': ('binaries', [20, 80, 320]),
+    'elf-depth': ('depth', [2, 4, 8]),
+    'elf-fanout': ('fanout', [2, 4, 8]),
+    'qml-modules': ('modules', [20, 80, 320]),
+    'qml-imports': ('imports', [2, 4, 8]),
+    'snippets': ('snippets', [0.0, 0.5, 1.0]),
+}
+
+
+def digest(out_dir):
+    """Hash the generated profiles, by name and content"""
+    h = hashlib.sha256()
+    for name in sorted(os.listdir(out_dir)):
+        h.update(name.encode() + b'\x00')
+        with open(os.path.join(out_dir, name), 'rb') as f:
+            h.update(f.read() + b'\x00')
+    return h.hexdigest()
+
+
+def git_commit(path):
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(path),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare_target(work_dir, params):
+    """Generate a target, unless it was already generated with the same parameters
+    and the same generator
+    """
+    with open(rootfs.__file__, 'rb') as f:
+        generator = hashlib.sha1(f.read()).hexdigest()
+    key = json.dumps([generator, params], sort_keys=True)
+    target = os.path.join(work_dir, hashlib.sha1(key.encode()).hexdigest()[:12])
+    stamp = os.path.join(target, 'params.json')
+    if os.path.isfile(stamp):
+        with open(stamp, 'r') as f:
+            if f.read() == key:
+                with open(os.path.join(target, 'argv.json'), 'r') as f:
+                    return target, json.load(f)
+    shutil.rmtree(target, ignore_errors=True)
+    argv = rootfs.generate(target, **params)
+    with open(os.path.join(target, 'argv.json'), 'w') as f:
+        json.dump(argv, f)
+    with open(stamp, 'w') as f:
+        f.write(key)
+    return target, argv
+
+
+def run_one(aa_scan3, target, argv, extra, rounds):
+    """Run aa-scan3 on a target, rounds times
+    :return: a tuple (wall, stats, digest) for the fastest round
+    """
+    best = None
+    for _ in range(rounds):
+        out_dir = os.path.join(target, 'out')
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.makedirs(out_dir)
+        stats_file = os.path.join(target, 'stats.json')
+        cmd = [sys.executable, aa_scan3] + argv + extra + ['--output-dir', out_dir, '--stats', stats_file]
+        start = time.perf_counter()
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        wall = time.perf_counter() - start
+        if best is None or wall < best[0]:
+            with open(stats_file, 'r') as f:
+                stats = json.load(f)
+            best = (wall, stats, digest(out_dir))
+    return best
+
+
+def plugin_times(stats):
+    """:return: a dict of plugin names to the total time spent in their methods"""
+    times = dict()
+    for scope, metrics in stats.items():
+        total = sum(v for k, v in metrics.items() if k.endswith('.time'))
+        if scope not in ('run', 'cache') and total:
+            times[scope] = total
+    return times
+
+
+def load_history(path):
+    history = []
+    if path and os.path.isfile(path):
+        with open(path, 'r') as f:
+            history = [json.loads(l) for l in f if l.strip()]
+    return history
+
+
+def check(result, history, threshold, window):
+    """Compare a result to the previous ones for the same scenario
+    :return: a list of flags, empty if none
+    """
+    previous = [h for h in history
+                if h['scenario'] == result['scenario'] and h['params'] == result['params']][-window:]
+    if not previous:
+        return []
+    flags = []
+    best = min(h['wall'] for h in previous)
+    if result['wall'] > best * (1 + threshold):
+        flags.append('slower: {:.3f}s vs {:.3f}s ({:+.0f}%)'.format(
+                     result['wall'], best, (result['wall'] / best - 1) * 100))
+    if result['digest'] != previous[-1]['digest']:
+        flags.append('profiles changed since {}'.format(previous[-1].get('commit') or previous[-1]['date']))
+    return flags
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--aa-scan3', metavar='PATH', default=os.path.join(TOP, 'aa-scan3'),
+                        help='The aa-scan3 to benchmark')
+    parser.add_argument('--scenario', metavar='NAME', action='append', choices=sorted(SCENARIOS),
+                        help='Only run this scenario; can be used more than once')
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='Number of runs for each scale of a scenario; the fastest is reported')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Passed to aa-scan3 --jobs')
+    parser.add_argument('--work-dir', metavar='DIR',
+                        help='Where to generate the targets; they are reused from one'
+                        + ' benchmark to the next. Default: a temporary directory')
+    parser.add_argument('--history', metavar='FILE', default='aa-scan3-bench.jsonl',
+                        help='The file to record the results in, and to compare them to')
+    parser.add_argument('--no-record', action='store_true',
+                        help='Compare the results to the history, but do not record them')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Flag a run slower than the best of the previous ones by more'
+                        + ' than this ratio')
+    parser.add_argument('--window', type=int, default=5,
+                        help='Number of previous runs of a scenario to compare to')
+    args = parser.parse_args()
+
+    aa_scan3 = os.path.abspath(args.aa_scan3)
+    commit = git_commit(aa_scan3)
+    history = load_history(args.history)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='aa-scan3-bench-')
+    os.makedirs(work_dir, exist_ok=True)
+
+    results = []
+    flagged = False
+    for name in args.scenario or sorted(SCENARIOS):
+        dimension, values = SCENARIOS[name]
+        for value in values:
+            params = {dimension: value}
+            target, argv = prepare_target(work_dir, params)
+            wall, stats, profiles = run_one(aa_scan3, target, argv, ['--jobs', str(args.jobs)], args.rounds)
+            result = {
+                'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'commit': commit,
+                'scenario': name,
+                'params': dict(params, jobs=args.jobs),
+                'wall': wall,
+                'files': stats['run'].get('files_scanned', 0),
+                'plugins': plugin_times(stats),
+                'digest': profiles,
+            }
+            flags = check(result, history, args.threshold, args.window)
+            flagged = flagged or bool(flags)
+            results.append(result)
+            print('{:<12} {:>10}={:<6} {:8.3f}s {:6} files  {}'.format(
+                  name, dimension, value, wall, result['files'],
+                  ' '.join('{}={:.3f}s'.format(p, t) for p, t in sorted(result['plugins'].items()))))
+            for flag in flags:
+                print('    REGRESSION: {}'.format(flag))
+
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if not args.no_record:
+        with open(args.history, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result, sort_keys=True) + '\n')
+    return 1 if flagged else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
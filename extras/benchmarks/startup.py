@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# Software Name : aa-scan3
+# SPDX-FileCopyrightText: Copyright (c) 2020 Orange
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# This software is distributed under the GPLv2;
+# see the COPYING file for more details.
+#
+# Author: Yann E. MORIN <yann.morin@orange.com> et al.
+
+"""
+Measure the start-up time of aa-scan3, i.e. the time it takes to find
+and load the plugins and register their options, by running a fresh
+interpreter for each round.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+COMMANDS = {
+    'python': [sys.executable, '-c', 'pass'],
+    'discover': [sys.executable, '-c', 'import aa_scan3.plugins'],
+    'help': [sys.executable, os.path.join(TOP, 'aa-scan3'), '--help'],
+}
+
+
+def bench(cmd, rounds):
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=TOP, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rounds', type=int, default=20,
+                        help='Number of rounds for each command')
+    parser.add_argument('--disable-plugins', metavar='PLUGINS',
+                        help='Also measure aa-scan3 --help with those plugins disabled')
+    args = parser.parse_args()
+
+    commands = dict(COMMANDS)
+    if args.disable_plugins:
+        commands['help-disabled'] = COMMANDS['help'] + ['--disable-plugins', args.disable_plugins]
+
+    for name, cmd in commands.items():
+        times = bench(cmd, args.rounds)
+        print('{:<14} min {:7.1f}ms  median {:7.1f}ms'.format(name, min(times) * 1000,
+                                                              statistics.median(times) * 1000))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())